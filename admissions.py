@@ -1,14 +1,31 @@
 #! /usr/local/bin/python3
-"""Build the admissions table."""
+"""Build or update the admissions table.
 
-import csv
+Each transfer admissions row is identified by its natural key: (student, application number,
+program, effective date, effective sequence, program action). The table keeps a fingerprint of each
+row's key (row_key) and of its contents (row_hash), so a refresh compares the new query file with
+the previous load and applies only the inserts, updates, and deletes needed, all in one
+transaction. The table is rebuilt from scratch only if it doesn't exist yet, or on request; a
+rebuild loads a shadow table, which is swapped in for the old one when it is complete.
+"""
+
+import argparse
+import hashlib
 import psycopg
-import sys
 
+from collections import defaultdict
+from bulk_loader import copy_rows
 from datetime import datetime
 from psycopg.rows import namedtuple_row
+from query_reader import QueryReader
+from timeline_utils import shadow_name, swap_in_shadow
 
-show_progress = len(sys.argv) > 1
+parser = argparse.ArgumentParser('Admissions table')
+parser.add_argument('-p', '--progress', action='store_true')
+parser.add_argument('-r', '--rebuild', action='store_true')
+parser.add_argument('-a', '--arrow', action='store_true', help='tokenize the query with pyarrow')
+args = parser.parse_args()
+show_progress = args.progress
 start_time = datetime.now()
 
 # More meaningful column names
@@ -39,77 +56,106 @@ csv_to_db = {'id': 'student_id',
              'external_application': 'external_application'
              }
 
-# Create the table
-with psycopg.connect('dbname=cuny_transfers', autocommit=True) as conn:
+# Columns that identify a row
+natural_key = ['student_id', 'application_number', 'academic_program', 'effective_date',
+               'effective_sequence', 'program_action']
+
+
+# fingerprint()
+# -------------------------------------------------------------------------------------------------
+def fingerprint(values) -> str:
+  """Hex digest of a sequence of column values (None and '' hash the same)."""
+  return hashlib.md5('\x1f'.join('' if value is None else value
+                                 for value in values).encode()).hexdigest()
+
+
+# Collect the transfer admissions rows from the query file, keyed by row_key
+# -------------------------------------------------------------------------------------------------
+db_cols = list(csv_to_db.values())
+key_indexes = [db_cols.index(col) for col in natural_key]
+new_rows = dict()
+occurrences = defaultdict(int)
+with QueryReader('./queries/CV_QNS_ADMISSIONS.csv', encoding='utf-8', progress=show_progress,
+                 backend='arrow' if args.arrow else 'stdlib') as reader:
+  cols = reader.headers
+  csv_indexes = [cols.index(csv_col) for csv_col in csv_to_db.keys()]
+  admit_type_index = cols.index('admit_type')
+  for line in reader:
+    if line[admit_type_index] in ['3', 'TRD', 'TRN']:
+      values = [line[index] for index in csv_indexes]
+      # Identical natural keys are distinguished by their order of occurrence in the file.
+      key_values = [values[index] for index in key_indexes]
+      key_digest = fingerprint(key_values)
+      occurrences[key_digest] += 1
+      row_key = f'{key_digest}.{occurrences[key_digest]}'
+      new_rows[row_key] = (fingerprint(values), values)
+
+# Apply the changes
+# -------------------------------------------------------------------------------------------------
+with psycopg.connect('dbname=cuny_transfers') as conn:
   with conn.cursor(row_factory=namedtuple_row) as cursor:
     cursor.execute("""
-    drop table if exists admissions;
-    create table admissions (
-      student_id              integer,
-      career                  text,
-      application_number      integer,
-      institution             text,
-      academic_program        text,
-      status                  text,
-      effective_date          date default null,
-      effective_sequence      integer,
-      program_action          text,
-      action_date             date default null,
-      action_reason           text,
-      admit_term              integer default null,
-      requirement_term        integer default null,
-      campus                  text,
-      admit_type              text, -- Select for trd|trn
-      application_fee_status  text,
-      application_fee_date    date default null,
-      last_school_attended    integer,
-      created_date            date default null,
-      last_updated_date       date default null,
-      application_complete    boolean,
-      completed_date          date default null,
-      application_date        date default null,
-      graduation_date         date default null,
-      override_deposit        boolean,
-      external_application    text
-    )
+    select count(*) as num_cols from information_schema.columns
+     where table_name = 'admissions' and column_name = 'row_key'
     """)
+    rebuild = args.rebuild or cursor.fetchone().num_cols == 0
+
+    if rebuild:
+      target = shadow_name('admissions')
+      cursor.execute(f"""
+      drop table if exists {target};
+      create table {target} (
+        row_key                 text,
+        row_hash                text,
+        student_id              integer,
+        career                  text,
+        application_number      integer,
+        institution             text,
+        academic_program        text,
+        status                  text,
+        effective_date          date default null,
+        effective_sequence      integer,
+        program_action          text,
+        action_date             date default null,
+        action_reason           text,
+        admit_term              integer default null,
+        requirement_term        integer default null,
+        campus                  text,
+        admit_type              text, -- Select for trd|trn
+        application_fee_status  text,
+        application_fee_date    date default null,
+        last_school_attended    integer,
+        created_date            date default null,
+        last_updated_date       date default null,
+        application_complete    boolean,
+        completed_date          date default null,
+        application_date        date default null,
+        graduation_date         date default null,
+        override_deposit        boolean,
+        external_application    text
+      );
+      """)
+      old_hashes = dict()
+    else:
+      target = 'admissions'
+      cursor.execute('select row_key, row_hash from admissions')
+      old_hashes = {row.row_key: row.row_hash for row in cursor}
+
+    deleted_keys = [key for key in old_hashes.keys() if key not in new_rows]
+    changed_keys = [key for key, (row_hash, values) in new_rows.items()
+                    if key in old_hashes and old_hashes[key] != row_hash]
+    added_keys = [key for key in new_rows.keys() if key not in old_hashes]
+
+    if deleted_keys or changed_keys:
+      cursor.execute(f'delete from {target} where row_key = any(%s)',
+                     (deleted_keys + changed_keys, ))
+    # Missing dates and numbers are loaded as NULL
+    copy_rows(cursor, target, ['row_key', 'row_hash'] + db_cols,
+              ([key, new_rows[key][0]] + new_rows[key][1] for key in changed_keys + added_keys))
+
+    if rebuild:
+      cursor.execute(f'create unique index on {target} (row_key)')
+      swap_in_shadow(cursor, 'admissions')
 
-    # Populate the table
-    total_lines = sum(1 for line in open('./queries/CV_QNS_ADMISSIONS.csv'))
-    with open('./queries/CV_QNS_ADMISSIONS.csv') as csv_file:
-      row_count = 0
-      reader = csv.reader(csv_file)
-      for line in reader:
-        if reader.line_num == 1:
-          cols = [col.lower().replace(' ', '_') for col in line]
-          admit_type_index = cols.index('admit_type')
-        else:
-          if show_progress:
-            print(f'\r{reader.line_num:,}/{total_lines:,}', end='')
-          if line[admit_type_index] in ['3', 'TRD', 'TRN']:
-            # Build the row to insert, omitting missing dates and integers
-            placeholders = ''
-            column_names = []
-            column_values = []
-            row = dict()
-            for index, value in enumerate(line):
-              if ((cols[index].endswith('_date') and not value)
-                 or (cols[index] in ['admit_term',
-                                     'requirement_term',
-                                     'last_school_attended'] and not value)):
-                continue
-              else:
-                try:
-                  column_names.append(csv_to_db[cols[index]])
-                  column_values.append(value)
-                  placeholders += ', %s'
-                except KeyError:
-                  # Skip unused columns
-                  pass
-            placeholders = placeholders.strip(', ')
-            column_names = ', '.join(column_names)
-            row_count += 1
-            cursor.execute(f'insert into admissions'
-                           f'({column_names}) values ({placeholders})', column_values)
-
-print(f'\n{row_count:,} rows\n{(datetime.now() - start_time).seconds} seconds')
+print(f'\n{len(new_rows):,} rows: {len(added_keys):,} added; {len(changed_keys):,} changed; '
+      f'{len(deleted_keys):,} deleted\n{(datetime.now() - start_time).seconds} seconds')
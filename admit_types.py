@@ -29,18 +29,21 @@ In the admissions CF query, the Inactive values 2,3,4 appear for admit terms pri
 So here, we accept Inactive Admit Types.
 
 """
-import csv
 import psycopg
 
-from collections import namedtuple
-from psycopg.rows import namedtuple_row
+from bulk_loader import load_query
+from timeline_utils import shadow_name, swap_in_shadow
+
+columns = {'institution': 'institution', 'admit_type': 'admit_type', 'description': 'descr'}
 
 with psycopg.connect('dbname=cuny_transfers') as conn:
-  with conn.cursor(row_factory=namedtuple_row) as cursor:
+  with conn.cursor() as cursor:
 
-    cursor.execute("""
-    drop table if exists admit_types;
-    create table admit_types (
+    # Build the new table as a shadow, and swap it in when it's complete.
+    shadow = shadow_name('admit_types')
+    cursor.execute(f"""
+    drop table if exists {shadow};
+    create table {shadow} (
     institution text,
     admit_type text,
     description text,
@@ -48,14 +51,6 @@ with psycopg.connect('dbname=cuny_transfers') as conn:
     )
     """)
 
-    with open('./queries/ADMIT_TYPE_TBL.csv') as att:
-      reader = csv.reader(att)
-      for line in reader:
-        if reader.line_num == 1:
-          cols = [c.lower().replace(' ', '_') for c in line]
-          Row = namedtuple('Row', cols)
-        else:
-          row = Row._make(line)
-          cursor.execute(f"""
-    insert into admit_types values ('{row.institution}', '{row.admit_type}', '{row.descr}')
-    """)
+    load_query(cursor, shadow, './queries/ADMIT_TYPE_TBL.csv', columns)
+
+    swap_in_shadow(cursor, 'admit_types')
@@ -12,13 +12,15 @@
 """
 
 import argparse
-import csv
 import datetime
 import sys
 
 from collections import namedtuple, defaultdict
 from pathlib import Path
 from pgconnection import PgConnection
+from query_reader import query_date
+from snapshot_archive import open_snapshot
+from snapshot_schema import Schema
 
 conn = PgConnection('cuny_transfers')
 cursor = conn.cursor()
@@ -108,44 +110,27 @@ Send_Key = namedtuple('Send_Key',
 Dest_Tuple = namedtuple('Dest_Tuple', 'dst_course_id, dst_offer_nbr')
 courses = defaultdict(set)
 
-with open(csv_file) as infile:
-  reader = csv.reader(infile)
+with open_snapshot(csv_file, columns=['sysdate', 'posted_date', 'src_institution',
+                                      'dst_institution', 'src_course_id', 'src_offer_nbr',
+                                      'dst_course_id', 'dst_offer_nbr']) as reader:
+  schema = Schema(reader.headers, ['sysdate', 'posted_date', 'src_institution', 'dst_institution',
+                                   'src_course_id', 'src_offer_nbr', 'dst_course_id',
+                                   'dst_offer_nbr'])
   for line in reader:
-    if reader.line_num == 1:
-      headers = [h.lower().replace(' ', '_') for h in line]
-      cols = [h for h in headers]
-
-      # Adjust for columns not present in queries prior to 2021-03-18
-      if 'comment' not in cols:
-        cols += ['user_id', 'reject_reason', 'transfer_overridden', 'override_reason', 'comment']
-        values_added = ('00000000', '', False, '', '')
-      else:
-        cols.remove('sysdate')
-        values_added = None
-
-      # columns {src_is_repeatable, dst_is_message, dst_is_blanket} from CF catalog (cached above).
-      cols.insert(1 + cols.index('src_offer_nbr'), 'src_is_repeatable')
-      cols.insert(1 + cols.index('dst_gpa'), 'dst_is_message')
-      cols.insert(1 + cols.index('dst_is_message'), 'dst_is_blanket')
-
-      placeholders = ((len(cols)) * '%s,').strip(', ')
-      cols = ', '.join([c for c in cols])
-      Row = namedtuple('Row', headers)
-    else:
-      # If SYSDATE is available, substitute it for file_date
-      if reader.line_num == 2 and values_added is None:
-        mo, da, yr = [int(x) for x in line[-1].split('/')]
-        file_date = datetime.date(yr, mo, da)
-      row = Row._make(line)
-
-      # Collect cases where one src course transfers as two different dst courses for the same
-      # student at the same time. Key is source course, destination institution, and posted date;
-      # value is set of destination courses. Print keys and values where destination set size > 1,
-      # looking up blanket creditness of destination courses.
-      key = Send_Key(row.posted_date, row.src_institution, row.dst_institution,
-                     int(row.src_course_id), int(row.src_offer_nbr))
-      courses[key].add(Dest_Tuple(int(row.dst_course_id),
-                                  int(row.dst_offer_nbr)))
+    if (row := schema.decode(line)) is None:
+      continue
+    # If SYSDATE is available, substitute it for file_date
+    if reader.num_records == 1 and row.sysdate is not None:
+      file_date = query_date(row.sysdate)
+
+    # Collect cases where one src course transfers as two different dst courses for the same
+    # student at the same time. Key is source course, destination institution, and posted date;
+    # value is set of destination courses. Print keys and values where destination set size > 1,
+    # looking up blanket creditness of destination courses.
+    key = Send_Key(row.posted_date, row.src_institution, row.dst_institution,
+                   int(row.src_course_id), int(row.src_offer_nbr))
+    courses[key].add(Dest_Tuple(int(row.dst_course_id),
+                                int(row.dst_offer_nbr)))
 print(len(courses), 'courses', file=sys.stderr)
 for key in sorted(courses.keys()):
   if len(courses[key]) > 1:
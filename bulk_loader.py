@@ -0,0 +1,108 @@
+#! /usr/local/bin/python3
+"""Load query files into tables with COPY.
+
+An initializer describes a table as a column map: each table column is paired with the query-file
+header it comes from, or with a function that computes it from the row (a namedtuple of the
+query file's columns). The map is resolved against the query file's headers once, and every row is
+streamed into the table with COPY.
+
+Values are converted according to the table's column types (looked up in information_schema), not
+per row: an empty string is NULL in any column that is not text, and other values in date columns
+are trimmed and left for Postgres to parse (so MM/DD/YYYY, ISO, and date-and-time forms all load).
+Missing dates need no special handling, and no value is ever quoted into SQL.
+
+Usage:
+  columns = {'institution': 'institution', 'admit_type': 'admit_type', 'description': 'descr'}
+  num_rows = load_query(cursor, shadow, './queries/ADMIT_TYPE_TBL.csv', columns)
+"""
+
+from collections import namedtuple
+from query_reader import QueryReader
+
+text_types = ['text', 'character varying', 'character']
+
+
+# column_types()
+# -------------------------------------------------------------------------------------------------
+def column_types(cursor, table: str) -> dict:
+  """Data type of each column of a table in the current schema, keyed by column name."""
+  cursor.execute("""
+  select column_name, data_type
+    from information_schema.columns
+   where table_schema = current_schema()
+     and table_name = %s
+  """, (table, ))
+  return {column_name: data_type for column_name, data_type in cursor.fetchall()}
+
+
+# converter()
+# -------------------------------------------------------------------------------------------------
+def converter(types: dict, columns: list):
+  """Function that converts a list of strings for the given table columns into COPY values."""
+  conversions = []
+  for column in columns:
+    data_type = types.get(column, 'text')
+    if data_type == 'date':
+      conversions.append(lambda value: value.strip() or None)
+    elif data_type in text_types:
+      conversions.append(None)
+    else:
+      conversions.append(lambda value: value if value != '' else None)
+
+  def convert(values: list) -> list:
+    return [value if conversion is None or value is None else conversion(value)
+            for conversion, value in zip(conversions, values)]
+  return convert
+
+
+# copy_rows()
+# -------------------------------------------------------------------------------------------------
+def copy_rows(cursor, table: str, columns: list, rows) -> int:
+  """COPY rows (sequences of strings, one per column) into table; return the number copied."""
+  convert = converter(column_types(cursor, table), columns)
+  num_rows = 0
+  with cursor.copy(f'copy {table} ({", ".join(columns)}) from stdin') as copy:
+    for values in rows:
+      copy.write_row(convert(values))
+      num_rows += 1
+  return num_rows
+
+
+# load_query()
+# -------------------------------------------------------------------------------------------------
+def load_query(cursor, table: str, query_file, columns: dict, where=None, unique: list = None,
+               encoding: str = 'utf-8', progress: bool = False, backend: str = 'stdlib') -> int:
+  """COPY the rows of a query file into table; return the number of rows loaded.
+
+  columns maps each table column to a query-file header, or to a function of the row. Rows for
+  which where(row) is false are skipped. If unique lists table columns, only the first row with
+  each combination of their values is loaded (like "on conflict do nothing").
+  """
+  with QueryReader(query_file, encoding=encoding, progress=progress, backend=backend) as reader:
+    Row = namedtuple('Row', reader.headers)
+    sources = []
+    for column, source in columns.items():
+      if callable(source):
+        sources.append(source)
+      elif source in reader.headers:
+        sources.append(reader.headers.index(source))
+      else:
+        raise ValueError(f'{query_file}: no {source} column for {table}.{column}')
+    computed = any(callable(source) for source in sources)
+    unique_indexes = [list(columns.keys()).index(column) for column in unique or []]
+
+    def rows():
+      keys = set()
+      for line in reader:
+        row = Row._make(line) if where or computed else None
+        if where and not where(row):
+          continue
+        values = [source(row) if callable(source) else line[source] for source in sources]
+        if unique_indexes:
+          key = tuple(values[index] for index in unique_indexes)
+          if key in keys:
+            continue
+          keys.add(key)
+        yield values
+
+    return copy_rows(cursor, table, list(columns.keys()), rows())
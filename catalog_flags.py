@@ -0,0 +1,93 @@
+#! /usr/local/bin/python3
+"""Repeatable, message, and blanket credit flags for CUNY catalog courses.
+
+The transfer loaders need to know, for every row, whether the sending course is repeatable and
+whether the receiving course is a message (MLA/MNL designation) or blanket credit (BKCR attribute)
+course. Those flags come from cuny_courses in the cuny_curriculum database, which changes rarely.
+
+catalog_flags() returns a dict mapping (course_id, offer_nbr) to a bitfield of the flags below.
+Only courses with at least one flag set are included, so a missing key means "no flags." The dict
+is saved in a local pickle file along with a fingerprint of the catalog, and the saved copy is used
+for as long as the fingerprint matches.
+"""
+
+import pickle
+import psycopg
+import sys
+
+from pathlib import Path
+from psycopg.rows import namedtuple_row
+
+REPEATABLE = 0x01
+MESSAGE = 0x02
+BLANKET = 0x04
+
+default_cache_file = Path('./cache/catalog_flags.pickle')
+
+
+# catalog_fingerprint()
+# -------------------------------------------------------------------------------------------------
+def catalog_fingerprint(cursor) -> str:
+  """Hash of the cuny_courses columns that determine the flags.
+
+  The hash is computed by the db server, so only the digest crosses the connection.
+  """
+  cursor.execute("""
+  select md5(string_agg(concat_ws(':', course_id, offer_nbr, repeatable, designation, attributes),
+                        ',' order by course_id, offer_nbr)) as fingerprint
+    from cuny_courses
+  """)
+  return cursor.fetchone().fingerprint
+
+
+# catalog_flags()
+# -------------------------------------------------------------------------------------------------
+def catalog_flags(cache_file: Path = default_cache_file) -> dict:
+  """Map (course_id, offer_nbr) to REPEATABLE | MESSAGE | BLANKET bits.
+
+  Use the cached copy if the catalog has not changed since it was saved; otherwise build the
+  mapping with a single query and save it.
+  """
+  with psycopg.connect('dbname=cuny_curriculum') as curric_conn:
+    with curric_conn.cursor(row_factory=namedtuple_row) as curric_cursor:
+      fingerprint = catalog_fingerprint(curric_cursor)
+
+      try:
+        with open(cache_file, 'rb') as cache:
+          cached_fingerprint, flags = pickle.load(cache)
+        if cached_fingerprint == fingerprint:
+          return flags
+      except (FileNotFoundError, EOFError, pickle.UnpicklingError, ValueError):
+        pass
+
+      print('Rebuild catalog flags cache', file=sys.stderr)
+      curric_cursor.execute(f"""
+      select course_id, offer_nbr,
+             (case when repeatable = 'Y' then {REPEATABLE} else 0 end
+            | case when designation in ('MLA', 'MNL') then {MESSAGE} else 0 end
+            | case when attributes ~* 'BKCR' then {BLANKET} else 0 end) as flags
+        from cuny_courses
+       where repeatable = 'Y'
+          or designation in ('MLA', 'MNL')
+          or attributes ~* 'BKCR'
+      """)
+      flags = {(int(row.course_id), int(row.offer_nbr)): row.flags
+               for row in curric_cursor.fetchall()}
+
+  cache_file.parent.mkdir(parents=True, exist_ok=True)
+  temp_file = cache_file.with_suffix('.tmp')
+  with open(temp_file, 'wb') as cache:
+    pickle.dump((fingerprint, flags), cache, protocol=pickle.HIGHEST_PROTOCOL)
+  temp_file.replace(cache_file)
+  return flags
+
+
+if __name__ == '__main__':
+  # Rebuild the cache if necessary, and report what's in it.
+  flags = catalog_flags()
+  counts = {name: sum(1 for value in flags.values() if value & bit)
+            for name, bit in [('repeatable', REPEATABLE),
+                              ('message', MESSAGE),
+                              ('blanket', BLANKET)]}
+  print(f'{len(flags):,} flagged courses:',
+        ', '.join(f'{count:,} {name}' for name, count in counts.items()))
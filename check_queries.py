@@ -4,21 +4,92 @@
 Copascetic Pre-Check (may be suppressed with no_precheck option):
   Check sizes of files in query_downloads/ against corresponding files in queries/.
 
-  If all OK and sizes match, archive current query and replace it with the new one.
+  If all OK and sizes match, and the new file's header is the same as the current one's, archive
+  current query and replace it with the new one. Queries are archived in the deduplicating
+  query_archive store (see query_archive.py), under the date of the query being replaced.
 
 Copascetic Post-Check:
-  If all queries in queries_dir have the same dates, delete oldest queries from the archive and exit
-  normally.
+  If all queries in queries_dir have the same dates, delete any oldest query files left in the
+  archive directory and exit normally. (Run prune_archive.py to drop old days from the store.)
 
   Otherwise exit errorly.
 
+The query manifest (queries/manifest.json) records each validated query file's size, mtime, content
+hash, number of rows, header signature, and SYSDATE (if it has one). The downloads are read to make
+their manifest entries in parallel, one process per file, and a file's entry is reused as long as
+its size and mtime are unchanged. update_timeline_tables.py uses the content hashes to skip
+initializers whose query has not changed since their last successful build.
 """
 import argparse
+import hashlib
+import json
 import re
 import sys
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
 from pathlib import Path
+from query_archive import archive_query
+from query_reader import QueryReader, content_hash, query_date
+
+manifest_name = 'manifest.json'
+
+
+# query_manifest_entry()
+# -------------------------------------------------------------------------------------------------
+def query_manifest_entry(path) -> dict:
+  """Size, mtime, content hash, number of rows, header signature, and SYSDATE of a query file."""
+  path = Path(path)
+  stats = path.stat()
+  sysdate = None
+  with QueryReader(path, encoding='utf-8') as reader:
+    headers = reader.headers
+    sysdate_index = headers.index('sysdate') if 'sysdate' in headers else None
+    for line in reader:
+      if sysdate is None and sysdate_index is not None:
+        sysdate = query_date(line[sysdate_index])
+    num_rows = reader.num_records
+  return {'size': stats.st_size,
+          'mtime': stats.st_mtime,
+          'content_hash': content_hash(path),
+          'num_rows': num_rows,
+          'header_signature': hashlib.md5('\x1f'.join(headers).encode()).hexdigest(),
+          'sysdate': sysdate.isoformat() if sysdate else None}
+
+
+# manifest_entries()
+# -------------------------------------------------------------------------------------------------
+def manifest_entries(paths: list) -> dict:
+  """Manifest entries for query files, made in parallel; keyed by file name."""
+  paths = list(paths)
+  if not paths:
+    return dict()
+  with ProcessPoolExecutor(max_workers=len(paths)) as executor:
+    return {path.name: entry
+            for path, entry in zip(paths, executor.map(query_manifest_entry, paths))}
+
+
+# read_query_manifest()
+# -------------------------------------------------------------------------------------------------
+def read_query_manifest(queries_dir) -> dict:
+  """The query manifest's entries, keyed by file name."""
+  try:
+    return json.loads(Path(queries_dir, manifest_name).read_text())
+  except FileNotFoundError:
+    return dict()
+
+
+# current_entry()
+# -------------------------------------------------------------------------------------------------
+def current_entry(path, manifest: dict) -> dict:
+  """A query file's manifest entry, or None if there is none or the file has changed since."""
+  path = Path(path)
+  stats = path.stat()
+  if ((entry := manifest.get(path.name)) is not None
+     and entry['size'] == stats.st_size and entry['mtime'] == stats.st_mtime):
+    return entry
+  return None
+
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser('Check query files')
@@ -38,15 +109,20 @@ if __name__ == '__main__':
   assert archive_dir.is_dir()
 
   is_copacetic = True
-  queries = queries_dir.glob('*.csv')
+  queries = list(queries_dir.glob('*.csv'))
+  manifest = read_query_manifest(queries_dir)
   if do_precheck:
     # For each file in queries, see if there is a newer one that is within 10% of its size.
     new_queries = download_dir.glob('*.csv')
 
     # Remove CF job IDs, if present
+    renamed_queries = []
     for new_query in new_queries:
       new_stem = re.sub(r'[\-0-9]+', '', new_query.stem)
-      new_query.rename(Path(download_dir, f'{new_stem}.csv'))
+      renamed_queries.append(new_query.rename(Path(download_dir, f'{new_stem}.csv')))
+
+    # Read the downloads, in parallel
+    new_entries = manifest_entries(renamed_queries)
 
     # Do each existing query file
     for query in queries:
@@ -59,19 +135,28 @@ if __name__ == '__main__':
         else:
           if args.verbose:
             print(f'{new_query.name} download date is ok')
-          if abs(query_stats.st_size - new_stats.st_size) < 0.1 * query_stats.st_size:
+          new_entry = new_entries[new_query.name]
+          if ((old_entry := manifest.get(query.name)) is not None
+             and old_entry['header_signature'] != new_entry['header_signature']):
+            is_copacetic = False
+            print(f'{new_query.name} header check FAILED: columns differ from {query.name}',
+                  file=sys.stderr)
+          elif abs(query_stats.st_size - new_stats.st_size) < 0.1 * query_stats.st_size:
             if args.verbose:
               print(f'{new_query.name} size is ok')
             # Archive query
-            new_stem = f'{date.fromtimestamp(query_stats.st_mtime)}.{query.stem}'
+            query_day = date.fromtimestamp(query_stats.st_mtime)
+            entry = archive_query(query, query_day, store=archive_dir)
             if args.log_changes:
-              print(f'Move {queries_dir.name}/{query.name} to {archive_dir.name}/{new_stem}.csv')
-            query.rename(Path(archive_dir, f'{new_stem}.csv'))
+              print(f'Archive {queries_dir.name}/{query.name} for {query_day} '
+                    f'({entry["new_bytes"]:,} new bytes)')
+            query.unlink()
             # Move download to queries_dir
             if args.log_changes:
               print(f'Move {download_dir.name}/{new_query.name} to '
                     f'{queries_dir.name}/{new_query.name}')
             new_query.rename(Path(queries_dir, new_query.name))
+            manifest[new_query.name] = new_entry
           else:
             is_copacetic = False
             print(f'{new_query.name} size check FAILED: {query_stats.st_size} :: '
@@ -86,17 +171,25 @@ if __name__ == '__main__':
   # Postcheck: be sure all the queries/ files are all dated the same
   reference_date = None
   for query in queries:
-    query_date = date.fromtimestamp(query.stat().st_mtime)
+    mtime_date = date.fromtimestamp(query.stat().st_mtime)
     if reference_date is None:
       reference_name = query.name
-      reference_date = query_date
+      reference_date = mtime_date
     else:
-      if query_date != reference_date:
-        print(f'{query.name} date ({query_date}) does not match {reference_name} date '
+      if mtime_date != reference_date:
+        print(f'{query.name} date ({mtime_date}) does not match {reference_name} date '
               f'{reference_date}', file=sys.stderr)
         is_copacetic = False
 
   if is_copacetic:
+    # Record the validated queries; read any that have no current manifest entry, in parallel
+    stale = [query for query in queries if current_entry(query, manifest) is None]
+    manifest.update(manifest_entries(stale))
+    manifest = {query.name: manifest[query.name] for query in queries}
+    temp_file = Path(queries_dir, manifest_name).with_suffix('.tmp')
+    temp_file.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    temp_file.replace(Path(queries_dir, manifest_name))
+
     print('Query dates match\n  prune archive')
     today = date.today()
     for file in archive_dir.glob('*csv'):
@@ -0,0 +1,293 @@
+#! /usr/local/bin/python3
+"""Record the evaluations added, removed, and modified between consecutive ALL snapshots.
+
+CUNYfirst overwrites previous evaluations, so transfers_applied can only see evaluations with new
+(student, course, posted_date) keys. This compares consecutive snapshots on the transfers_applied
+primary key and records in evaluation_changes every key that was added, removed, or had its other
+columns modified, along with the dates of the two snapshots.
+
+A snapshot covers only the evaluations posted in about the past week, so keys whose posted_date
+has aged out of the window are not in the next snapshot. A key is recorded as removed only if its
+posted_date is on or after the earliest posted_date in the newer snapshot; keys before that are
+simply outside its window.
+
+Each snapshot is reduced to a key file: one line per key, in key order, giving the key and a digest
+of the row's other columns. The compared values are normalized (stripped, with integers written
+without leading zeros) before they are digested, so a CSV snapshot and an archived (Parquet) one
+with the same contents have the same digests. Key files are built with an external sort (sorted
+runs of sort_run_size rows, merged), and are kept in the cache directory so each snapshot is sorted
+only once. Comparing two snapshots is then a single merge pass over their key files; neither
+snapshot is ever held in memory.
+
+Usage:
+  evaluation_changes.py [--latest] [snapshot ...]   # Default: every downloads/CV*ALL* file
+
+Pairs of snapshots that have already been compared (recorded in evaluation_change_pairs, whether or
+not they differed) are skipped. With --latest, only the two most recent snapshots are compared.
+"""
+
+import argparse
+import datetime
+import hashlib
+import heapq
+import psycopg
+import sys
+import tempfile
+
+from itertools import groupby
+from pathlib import Path
+from query_reader import query_date
+from skip_accounting import SkipAccount
+from snapshot_archive import manifest_entry, open_snapshot
+
+key_dir = Path('./cache/snapshot_keys')
+key_file_version = 2
+sort_run_size = 1_000_000
+
+# transfers_applied primary key columns, and the other query columns that are compared
+key_cols = ['student_id', 'src_course_id', 'src_offer_nbr', 'dst_course_id', 'dst_offer_nbr',
+            'articulation_term', 'posted_date']
+compared_cols = ['src_institution', 'enrollment_term', 'enrollment_session', 'model_status',
+                 'transfer_model_nbr', 'src_subject', 'src_catalog_nbr', 'src_designation',
+                 'src_grade', 'src_gpa', 'src_description', 'academic_program', 'units_taken',
+                 'dst_institution', 'dst_designation', 'dst_subject', 'dst_catalog_nbr',
+                 'dst_grade', 'dst_gpa']
+
+
+# key_string()
+# -------------------------------------------------------------------------------------------------
+def key_string(values: list) -> str:
+  """A row's key, formatted so that string order is the same as key order."""
+  student_id, src_course_id, src_offer_nbr, dst_course_id, dst_offer_nbr, term, posted = values
+  posted_date = query_date(posted)
+  return (f'{int(student_id):010}:{int(src_course_id):08}:{int(src_offer_nbr):03}:'
+          f'{int(dst_course_id):08}:{int(dst_offer_nbr):03}:{int(term):05}:'
+          f'{posted_date.isoformat() if posted_date else ""}')
+
+
+# normalized()
+# -------------------------------------------------------------------------------------------------
+def normalized(value) -> str:
+  """A compared column's value as text, the same whether it came from a CSV or Parquet snapshot."""
+  if value is None:
+    return ''
+  text = str(value).strip()
+  return str(int(text)) if text.isdecimal() else text
+
+
+# key_file()
+# -------------------------------------------------------------------------------------------------
+def key_file(snapshot: Path) -> Path:
+  """Build (if necessary) a snapshot's key file; return its path.
+
+  The first line of a key file is the format version, the snapshot's date, and the earliest
+  posted_date in the snapshot. Each following line is a key and the digest of its rows' compared
+  columns. (If a key occurs more than once, the digest covers all its rows.) Key files in an older
+  format are rebuilt.
+
+  Rows with the wrong number of fields, a non-numeric id, or an invalid posted_date are skipped
+  and counted as schema_mismatch, as the transfer loaders do; the counts are reported on stderr.
+  """
+  key_path = Path(key_dir, f'{snapshot.stem}.keys')
+  if key_path.exists():
+    with open(key_path) as keys:
+      if keys.readline().split()[0] == f'v{key_file_version}':
+        return key_path
+  key_dir.mkdir(parents=True, exist_ok=True)
+
+  if archived := manifest_entry(snapshot):
+    snapshot_date = datetime.date.fromisoformat(archived['snapshot_date'])
+  else:
+    snapshot_date = datetime.date.fromtimestamp(snapshot.stat().st_mtime)
+
+  # Sorted runs
+  runs = []
+  earliest_post = None
+  skips = SkipAccount()
+  with open_snapshot(snapshot, columns=['sysdate'] + key_cols + compared_cols,
+                     encoding='utf-8') as reader:
+    headers = reader.headers
+    key_indexes = [headers.index(col) for col in key_cols]
+    compared_indexes = [headers.index(col) for col in compared_cols if col in headers]
+    run = []
+    for line in reader:
+      if len(line) != len(headers):
+        skips.skip('schema_mismatch', line)
+        continue
+      try:
+        key = key_string([line[index] for index in key_indexes])
+        if reader.num_records == 1 and 'sysdate' in headers:
+          snapshot_date = query_date(line[headers.index('sysdate')]) or snapshot_date
+      except ValueError:
+        skips.skip('schema_mismatch', line)
+        continue
+      digest = hashlib.blake2b('\x1f'.join(normalized(line[index])
+                                           for index in compared_indexes).encode(),
+                               digest_size=8).hexdigest()
+      posted = key.split(':')[-1]
+      if posted and (earliest_post is None or posted < earliest_post):
+        earliest_post = posted
+      run.append(f'{key} {digest}\n')
+      if len(run) == sort_run_size:
+        runs.append(write_run(run))
+        run = []
+    runs.append(write_run(run))
+  if skips.total:
+    print(f'{snapshot.name}: {skips.total:,} rows skipped\n{skips}', file=sys.stderr)
+
+  # Merge the runs, combining the digests of duplicate keys
+  temp_path = key_path.with_suffix('.tmp')
+  with open(temp_path, 'w') as keys:
+    print(f'v{key_file_version}', snapshot_date.isoformat(), earliest_post or '-', file=keys)
+    for key, lines in groupby(heapq.merge(*runs), key=lambda line: line.split(' ')[0]):
+      digests = [line.split(' ')[1].strip() for line in lines]
+      if len(digests) > 1:
+        digests = [hashlib.blake2b(''.join(digests).encode(), digest_size=8).hexdigest()]
+      print(key, digests[0], file=keys)
+  for run in runs:
+    run.close()
+  temp_path.replace(key_path)
+  return key_path
+
+
+# write_run()
+# -------------------------------------------------------------------------------------------------
+def write_run(lines: list):
+  """Sort lines into an anonymous temporary file; return the file, positioned at its start."""
+  lines.sort()
+  run = tempfile.TemporaryFile('w+', dir=key_dir)
+  run.writelines(lines)
+  run.seek(0)
+  return run
+
+
+# key_file_dates()
+# -------------------------------------------------------------------------------------------------
+def key_file_dates(key_path: Path) -> tuple:
+  """The snapshot date and the earliest posted_date (None if none) recorded in a key file."""
+  with open(key_path) as keys:
+    _, snapshot_date, earliest_post = keys.readline().split()
+  return (datetime.date.fromisoformat(snapshot_date),
+          None if earliest_post == '-' else datetime.date.fromisoformat(earliest_post))
+
+
+# key_pairs()
+# -------------------------------------------------------------------------------------------------
+def key_pairs(key_path: Path):
+  """Generate the (key, digest) pairs in a key file."""
+  with open(key_path) as keys:
+    keys.readline()
+    for line in keys:
+      key, digest = line.split()
+      yield key, digest
+
+
+# diff_snapshots()
+# -------------------------------------------------------------------------------------------------
+def diff_snapshots(old_pairs, new_pairs, earliest_post: datetime.date = None):
+  """Merge two key-ordered (key, digest) streams; yield (key, change) for each difference.
+
+  Keys missing from the new stream are reported as removed only if their posted_date is on or
+  after earliest_post (the start of the new snapshot's window); if earliest_post is None, none are.
+  """
+  window_start = earliest_post.isoformat() if earliest_post else None
+  old = next(old_pairs, None)
+  new = next(new_pairs, None)
+  while old is not None or new is not None:
+    if new is None or (old is not None and old[0] < new[0]):
+      if window_start is not None and old[0].split(':')[-1] >= window_start:
+        yield old[0], 'removed'
+      old = next(old_pairs, None)
+    elif old is None or new[0] < old[0]:
+      yield new[0], 'added'
+      new = next(new_pairs, None)
+    else:
+      if old[1] != new[1]:
+        yield new[0], 'modified'
+      old = next(old_pairs, None)
+      new = next(new_pairs, None)
+
+
+# key_values()
+# -------------------------------------------------------------------------------------------------
+def key_values(key: str) -> list:
+  """Column values from a key string."""
+  *ints, posted_date = key.split(':')
+  return [int(value) for value in ints] + [posted_date or None]
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser('Evaluation changes')
+  parser.add_argument('-l', '--latest', action='store_true')
+  parser.add_argument('snapshots', nargs='*')
+  args = parser.parse_args()
+
+  if args.snapshots:
+    snapshots = [Path(snapshot) for snapshot in args.snapshots]
+  else:
+    snapshots = sorted(Path('./downloads').glob('CV*ALL*'), key=lambda path: path.stat().st_mtime)
+  if args.latest:
+    snapshots = snapshots[-2:]
+  if len(snapshots) < 2:
+    sys.exit('Need at least two snapshots to compare.')
+
+  with psycopg.connect('dbname=cuny_transfers') as conn:
+    with conn.cursor() as cursor:
+      cursor.execute("""
+      create table if not exists evaluation_changes (
+        student_id          integer,
+        src_course_id       integer,
+        src_offer_nbr       integer,
+        dst_course_id       integer,
+        dst_offer_nbr       integer,
+        articulation_term   integer,
+        posted_date         date,
+        change              text,   -- added | removed | modified
+        old_snapshot        date,
+        new_snapshot        date
+      );
+      create index if not exists evaluation_changes_student on evaluation_changes (student_id);
+      create index if not exists evaluation_changes_snapshots
+          on evaluation_changes (old_snapshot, new_snapshot);
+      """)
+      cursor.execute("select to_regclass('evaluation_change_pairs') is null as is_missing")
+      if cursor.fetchone()[0]:
+        cursor.execute("""
+        create table evaluation_change_pairs (
+          old_snapshot      date,
+          new_snapshot      date,
+          num_added         integer,
+          num_removed       integer,
+          num_modified      integer,
+          compared_at       timestamp,
+          primary key (old_snapshot, new_snapshot)
+        );
+        insert into evaluation_change_pairs (old_snapshot, new_snapshot, compared_at)
+        select distinct old_snapshot, new_snapshot, now() from evaluation_changes;
+        """)
+      conn.commit()
+
+      for old_snapshot, new_snapshot in zip(snapshots, snapshots[1:]):
+        old_keys = key_file(old_snapshot)
+        new_keys = key_file(new_snapshot)
+        old_date, _ = key_file_dates(old_keys)
+        new_date, earliest_post = key_file_dates(new_keys)
+        cursor.execute("""
+        select 1 from evaluation_change_pairs where old_snapshot = %s and new_snapshot = %s
+        """, (old_date, new_date))
+        if cursor.rowcount > 0:
+          continue
+
+        counts = {'added': 0, 'removed': 0, 'modified': 0}
+        with cursor.copy(f'copy evaluation_changes ({", ".join(key_cols)}, change, '
+                         'old_snapshot, new_snapshot) from stdin') as copy:
+          for key, change in diff_snapshots(key_pairs(old_keys), key_pairs(new_keys),
+                                            earliest_post):
+            counts[change] += 1
+            copy.write_row(key_values(key) + [change, old_date, new_date])
+        cursor.execute("""
+        insert into evaluation_change_pairs values (%s, %s, %s, %s, %s, now())
+        """, (old_date, new_date, counts['added'], counts['removed'], counts['modified']))
+        conn.commit()
+        print(f'{old_date} → {new_date}: ' + '; '.join(f'{count:,} {change}'
+                                                      for change, count in counts.items()))
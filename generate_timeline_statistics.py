@@ -446,42 +446,39 @@ for institution in institutions:
     # ---------------------------------------------------------------------------------------------
     if student_id_list != '':
       cursor.execute(f"""
-        select student_id, posted_date
-          from transfers_applied
-         where dst_institution ~* '{institution}'
+        select student_id, min(first_eval) as first_eval,
+                           max(latest_eval) as latest_eval
+          from evaluation_summary
+         where dst_college = '{institution}'
            and articulation_term {term_clause}
-           and student_id in ({student_id_list})
-      group by student_id, posted_date
-        """)
+           and student_id = any(%s)
+      group by student_id
+        """, (list(student_ids), ))
       for row in cursor.fetchall():
         student_id = int(row.student_id)
-        if (posted_date := row.posted_date) > datetime.date(1901, 1, 1):
-          if cohorts[cohort_key][student_id]['first_eval'] is None \
-             or posted_date < cohorts[cohort_key][student_id]['first_eval']:
-            cohorts[cohort_key][student_id]['first_eval'] = posted_date
-            cohorts[super_cohort_key][student_id]['first_eval'] = posted_date
-          if cohorts[cohort_key][student_id]['latest_eval'] is None \
-             or posted_date > cohorts[cohort_key][student_id]['latest_eval']:
-            cohorts[cohort_key][student_id]['latest_eval'] = posted_date
-            cohorts[super_cohort_key][student_id]['latest_eval'] = posted_date
+        cohorts[cohort_key][student_id]['first_eval'] = row.first_eval
+        cohorts[super_cohort_key][student_id]['first_eval'] = row.first_eval
+
+        cohorts[cohort_key][student_id]['latest_eval'] = row.latest_eval
+        cohorts[super_cohort_key][student_id]['latest_eval'] = row.latest_eval
 
     # Registration dates
     # ---------------------------------------------------------------------------------------------
     # Although we collect drop dates, we report only first and last add dates (for now).
     if student_id_list != '':
       cursor.execute(f"""
-      select student_id, min(add_date) as first_add,
-                         max(add_date) as last_add,
-                         count(add_date) as num_adds,
-                         min(drop_date) as first_drop,
-                         max(drop_date) as last_drop,
-                         count(drop_date) as num_drops
-      from registrations
+      select student_id, min(first_add) as first_add,
+                         max(last_add) as last_add,
+                         sum(num_adds) as num_adds,
+                         min(first_drop) as first_drop,
+                         max(last_drop) as last_drop,
+                         sum(num_drops) as num_drops
+      from registration_summary
       where institution = '{institution}01'
       and term {term_clause}
-      and student_id in ({student_id_list})
+      and student_id = any(%s)
       group by institution, student_id
-        """)
+        """, (list(student_ids), ))
       for row in cursor.fetchall():
 
         cohorts[cohort_key][row.student_id]['first_reg'] = row.first_add
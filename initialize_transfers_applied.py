@@ -5,21 +5,45 @@ The "full" CUNYfirst query includes evaluations from Spring 2018 to date. But we
 daily updates on March 3, 2021, so here, events after March 2, 2021 are skipped, to allow subsequent
 updates to note changes. (re-evalations)
 Also, ignore records where the model_status is not "Posted."
+
+The file is divided at record boundaries into one part per job (-j, default: number of cores). Each
+part is parsed in its own process and COPYed into an unlogged staging table, which is then merged
+into transfers_applied in a single statement.
+
+With --resumable, each part is instead merged and committed every --batch_size posted rows, and
+the population_progress table records how far each part has gotten. If the population is
+interrupted, running with --resumable again (for the same FULL file) continues each part from its
+last checkpoint, without dropping anything. population_progress is dropped when the population is
+complete.
 """
 
-import csv
+import argparse
 import datetime
+import os
 import psycopg
 import resource
 import sys
 
-from collections import namedtuple
+from catalog_flags import catalog_flags
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from psycopg.rows import namedtuple_row
+from query_reader import QueryReader, content_hash, query_date, record_boundaries
+from skip_accounting import SkipAccount
+from transfers_population import (create_evaluation_tables, create_transfer_tables, load_chunk,
+                                   merge_staged_rows, progress_ddl, staging_ddl)
 
 soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
 resource.setrlimit(resource.RLIMIT_NOFILE, [0x800, hard])
 
+parser = argparse.ArgumentParser('Initialize Transfers')
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+parser.add_argument('-r', '--resumable', action='store_true')
+parser.add_argument('-b', '--batch_size', type=int, default=500_000,
+                    help='posted rows per commit when resumable')
+args = parser.parse_args()
+num_jobs = max(1, args.jobs)
+
 possibles = Path('./downloads').glob('*FULL*')
 the_file = None
 for possible in possibles:
@@ -31,182 +55,130 @@ if the_file is None:
 file_name = the_file.name
 file_date = datetime.date.fromtimestamp(the_file.stat().st_mtime)
 print(f"Using: {file_name} {file_date.strftime('%B %d, %Y')}", file=sys.stderr)
-print('I advise you not to do this. Repent! (or proceed anyway?) [R/p] ',
-      end='', file=sys.stderr)
-if input().lower().startswith('p'):
-  print('Don’t say you weren’t warned!', file=sys.stderr)
-else:
-  sys.exit('Ill-advised consequences averted!')
-
-curric_conn = psycopg.connect('dbname=cuny_curriculum')
-curric_cursor = curric_conn.cursor(row_factory=namedtuple_row)
+file_hash = content_hash(the_file)
 
 trans_conn = psycopg.connect('dbname=cuny_transfers')
 trans_cursor = trans_conn.cursor(row_factory=namedtuple_row)
 
-trans_cursor.execute("""
-
-drop table if exists transfers_applied cascade;
-
-create table transfers_applied (
-  student_id          integer not NULL,
-  src_institution     text not NULL,
-  enrollment_term     integer not NULL,
-  enrollment_session  text not NULL,
-  articulation_term   integer not NULL,
-  model_status        text not NULL,
-  model_nbr           integer not NULL,
-  posted_date         date,
-  src_subject text    not NULL,
-  src_catalog_nbr     text not NULL,
-  src_designation     text not NULL,
-  src_grade           text not NULL,
-  src_gpa             real not NULL,
-  src_course_id       integer not NULL,
-  src_offer_nbr       integer not NULL,
-  src_is_repeatable   boolean not NULL,
-  src_description     text not NULL,
-  academic_program    text not NULL,
-  units_taken         real not NULL,
-  dst_institution     text not NULL,
-  dst_designation     text not NULL,
-  dst_course_id       integer not NULL,
-  dst_offer_nbr       integer not NULL,
-  dst_subject         text not NULL,
-  dst_catalog_nbr     text not NULL,
-  dst_grade           text not NULL,
-  dst_gpa             real not NULL,
-  dst_is_message      boolean not NULL,
-  dst_is_blanket      boolean not NULL,
-  credit_source_type  text,
-
-  primary key (student_id, src_course_id, src_offer_nbr,
-                           dst_course_id, dst_offer_nbr,
-                           articulation_term, posted_date)
-);
-
-
--- The update_history table
-drop table if exists update_history;
-
-create table update_history (
-file_name   text primary key,
-file_date   date,
-last_post   date,
-num_records integer,
-num_added   integer,
-num_skipped integer
-);
-
-commit;
-""")
-
-# Caches of all repeatable, message, and blanket credit courses
-curric_cursor.execute("select course_id, offer_nbr from cuny_courses where repeatable = 'Y'")
-repeatables = [(int(row.course_id), int(row.offer_nbr)) for row in curric_cursor.fetchall()]
-curric_cursor.execute("""select course_id, offer_nbr
-                       from cuny_courses
-                       where designation in ('MLA', 'MNL')""")
-messages = [(int(row.course_id), int(row.offer_nbr)) for row in curric_cursor.fetchall()]
-curric_cursor.execute("""select course_id, offer_nbr
-                       from cuny_courses
-                       where attributes ~* 'BKCR'""")
-blankets = [(int(row.course_id), int(row.offer_nbr)) for row in curric_cursor.fetchall()]
-curric_cursor.close()
-
-last_post = None
-num_added = 0
-num_changed = 0   # Will not change here.
-num_skipped = 0
+# The parts of an interrupted resumable population of this file, if there is one
+parts = []
+if args.resumable:
+  trans_cursor.execute("select to_regclass('population_progress') is not null as has_progress")
+  if trans_cursor.fetchone().has_progress:
+    trans_cursor.execute("""
+    select part_start, part_end from population_progress where content_hash = %s
+     order by part_start
+    """, (file_hash, ))
+    parts = [(row.part_start, row.part_end) for row in trans_cursor]
+  trans_conn.commit()
+
+if parts:
+  print(f'Resume populating from {file_name}', file=sys.stderr)
+else:
+  print('I advise you not to do this. Repent! (or proceed anyway?) [R/p] ',
+        end='', file=sys.stderr)
+  if input().lower().startswith('p'):
+    print('Don’t say you weren’t warned!', file=sys.stderr)
+  else:
+    sys.exit('Ill-advised consequences averted!')
+
+  create_transfer_tables(trans_cursor)
+  trans_cursor.execute("""
+
+  drop table if exists evaluation_events;
+  drop table if exists evaluation_summary;
+  drop table if exists population_progress;
+
+  -- The update_history table
+  drop table if exists update_history;
+
+  create table update_history (
+  file_name   text primary key,
+  file_date   date,
+  last_post   date,
+  num_records integer,
+  num_added   integer,
+  num_skipped integer,
+  content_hash text,
+  skip_summary jsonb
+  );
+  create index update_history_content_hash on update_history (content_hash);
+
+  -- Unlogged staging table for the parallel COPY streams
+  drop table if exists transfers_staging;
+  """)
+  trans_cursor.execute(staging_ddl)
+  create_evaluation_tables(trans_cursor)
+
+  # Divide the file into parts; a resumable population records them with its progress
+  boundaries = record_boundaries(the_file, num_jobs)
+  parts = list(zip(boundaries, boundaries[1:]))
+  if args.resumable:
+    trans_cursor.execute(progress_ddl)
+    with trans_cursor.copy('copy population_progress (part_start, part_end, content_hash, '
+                           'next_offset) from stdin') as copy:
+      for start, end in parts:
+        copy.write_row((start, end, file_hash, start))
+  trans_conn.commit()
+
+# Repeatable, message, and blanket credit flags for all catalog courses
+course_flags = catalog_flags()
 
 march_2_2021 = datetime.date(2021, 3, 2)
 
-cols = ['student_id', 'src_institution', 'enrollment_term', 'enrollment_session',
-        'articulation_term', 'model_status', 'model_nbr', 'posted_date', 'src_subject',
-        'src_catalog_nbr', 'src_designation', 'src_grade', 'src_gpa', 'src_course_id',
-        'src_offer_nbr', 'src_is_repeatable', 'src_description', 'academic_program', 'units_taken',
-        'dst_institution', 'dst_designation', 'dst_course_id', 'dst_offer_nbr', 'dst_subject',
-        'dst_catalog_nbr', 'dst_grade', 'dst_gpa', 'dst_is_message', 'dst_is_blanket']
-placeholders = ((len(cols)) * '%s,').strip(', ')
-cols = ','.join(cols)
+# SYSDATE, if available, is in the first record
+with QueryReader(the_file, encoding='utf-8') as reader:
+  headers = reader.headers
+  if 'sysdate' in headers:
+    first_line = next(iter(reader), None)
+    if first_line is not None:
+      file_date = query_date(first_line[headers.index('sysdate')])
 
 with open('./Logs/populate.log', 'w') as logfile:
 
-  # There are discrepancies between the number of lines in the .csv file and the number of records
-  # actually found, presumably because of newlines in the comments field.
-  num_records = 0
-  num_lines = len(open(the_file, newline=None, errors='backslashreplace').readlines()) - 1
-  with open(the_file, newline=None, errors='backslashreplace') as csvfile:
-    reader = csv.reader(csvfile, )
-
-    for line in reader:
-
-      if reader.line_num == 1:
-        headers = [h.lower().replace(' ', '_') for h in line]
-        Row = namedtuple('Row', headers)
-
-      else:
-
-        num_records += 1
-        print(f'    {num_records:6,}/{num_lines:6,}\r', end='', file=sys.stderr)
-
-        row = Row._make(line)
-        if reader.line_num == 2 and 'sysdate' in headers:
-          mo, da, yr = row.sysdate.split('/')
-          file_date = datetime.date(int(yr), int(mo), int(da))
-
-        if '/' in row.posted_date:
-          mo, da, yr = row.posted_date.split('/')
-          posted_date = datetime.date(int(yr), int(mo), int(da))
-          if last_post is None or last_post < posted_date:
-            last_post = posted_date
-        else:
-          # Missing posted_date
-          posted_date = datetime.date(1901, 1, 1)
-
-        # Skip records that are not posted or which have a posted_date greater than March 2, 2021
-        if row.model_status != 'Posted' or posted_date > march_2_2021:
-          num_skipped += 1
-          continue
-
-        src_course_id = int(row.src_course_id)
-        src_offer_nbr = int(row.src_offer_nbr)
-        src_catalog_nbr = row.src_catalog_nbr.strip()
-        dst_course_id = int(row.dst_course_id)
-        dst_offer_nbr = int(row.dst_offer_nbr)
-        dst_catalog_nbr = row.dst_catalog_nbr.strip()
-
-        # Is the src course repeatable; is dst course in MESG or BKCR
-        src_is_repeatable = (src_course_id, src_offer_nbr) in repeatables
-        dst_is_message = (dst_course_id, dst_offer_nbr) in messages
-        dst_is_blanket = (dst_course_id, dst_offer_nbr) in blankets
-
-        value_tuple = (row.student_id, row.src_institution, row.enrollment_term,
-                       row.enrollment_session, row.articulation_term, row.model_status,
-                       row.transfer_model_nbr, posted_date, row.src_subject, src_catalog_nbr,
-                       row.src_designation, row.src_grade, row.src_gpa, row.src_course_id,
-                       row.src_offer_nbr, src_is_repeatable, row.src_description,
-                       row.academic_program, row.units_taken, row.dst_institution,
-                       row.dst_designation, row.dst_course_id, row.dst_offer_nbr, row.dst_subject,
-                       dst_catalog_nbr, row.dst_grade, row.dst_gpa, dst_is_message, dst_is_blanket)
-        trans_cursor.execute(f'insert into transfers_applied ({cols}) values ({placeholders}) '
-                             f'on conflict do nothing',
-                             value_tuple)
-        if trans_cursor.rowcount == 1:
-          num_added += 1
-        else:
-          print(f'Skipped {value_tuple}', file=logfile)
-          num_skipped += 1
+  # Parse the parts of the file in parallel
+  print(f'Parse {len(parts)} parts using {num_jobs} processes', file=sys.stderr)
+  batch_size = args.batch_size if args.resumable else None
+  with ProcessPoolExecutor(max_workers=num_jobs) as executor:
+    futures = [executor.submit(load_chunk, the_file, start, end, course_flags, march_2_2021,
+                               batch_size)
+               for start, end in parts]
+    results = []
+    for part_num, future in enumerate(futures, 1):
+      results.append(future.result())
+      print(f'\r    {part_num:3}/{len(futures):3} parts', end='', file=sys.stderr)
+    print(file=sys.stderr)
+
+  num_lines = sum(result.num_lines for result in results)
+  num_records = sum(result.num_records for result in results)
+  num_staged = sum(result.num_staged for result in results)
+  skips = SkipAccount()
+  for result in results:
+    skips.merge(result.skips)
+  last_posts = [result.last_post for result in results if result.last_post is not None]
+  last_post = max(last_posts) if last_posts else None
+
+  # Merge the staged rows into transfers_applied (unless the parts merged their own); duplicate
+  # keys are skipped.
+  if args.resumable:
+    num_added = sum(result.num_added for result in results)
+  else:
+    num_added = merge_staged_rows(trans_cursor).num_added
+  skips.add('duplicate_key', num_staged - num_added)
+  num_skipped = skips.total
+  trans_cursor.execute('truncate transfers_staging')
 
   # Report difference between num_lines and num_records.
-  print(f'Lines: {num_lines}\nRecords{num_records}', file=logfile)
+  print(f'Lines: {num_lines}\nRecords{num_records}\nStaged: {num_staged}\nAdded: {num_added}\n'
+        f'Skipped: {num_skipped}\n{skips}', file=logfile)
 
   # Update the update_history table
   trans_cursor.execute(f"""
   insert into update_history values(
             '{file_name}', '{file_date}', '{last_post}',
-            {num_records}, {num_added}, {num_skipped})
-  """)
+            {num_records}, {num_added}, {num_skipped}, '{file_hash}', %s)
+  """, (skips.to_json(headers), ))
+  trans_cursor.execute('drop table if exists population_progress')
 
 trans_conn.commit()
 exit()
@@ -4,26 +4,35 @@
 Used to see where students are coming from when applying.
 """
 
-import csv
 import psycopg
 
-from collections import namedtuple
+from bulk_loader import load_query
 from pathlib import Path
-from psycopg.rows import namedtuple_row
+from timeline_utils import shadow_name, swap_in_shadow
+
+# (Ids are compared as integers, so '0123' and '123' are the same organization.)
+columns = {'id': lambda row: int(row.external_org_id),
+           'search_name': 'search_name',
+           'organization_type': 'organization_type',
+           'description': 'description',
+           'status': 'status_as_of_effective_date'
+           }
 
 latest = None
 paths = Path('./queries').glob('*ORG*')
 for path in paths:
-  if latest is None or path.stat().st_mtime > latest.st_mtime:
+  if latest is None or path.stat().st_mtime > latest.stat().st_mtime:
     latest = path
 if latest is None:
   exit('No Organizations query found.')
 
 with psycopg.connect('dbname=cuny_transfers') as conn:
-  with conn.cursor(row_factory=namedtuple_row) as cursor:
-    cursor.execute("""
-    drop table if exists organizations;
-    create table organizations (
+  with conn.cursor() as cursor:
+    # Build the new table as a shadow, and swap it in when it's complete.
+    shadow = shadow_name('organizations')
+    cursor.execute(f"""
+    drop table if exists {shadow};
+    create table {shadow} (
     id integer primary key,
     search_name text,
     organization_type text,
@@ -31,17 +40,8 @@ with psycopg.connect('dbname=cuny_transfers') as conn:
     status text
     )
     """)
-    with open (latest) as csv_file:
-      reader = csv.reader(csv_file)
-      for line in reader:
-        if reader.line_num == 1:
-          cols = [col.lower().replace(' ', '_') for col in line]
-          Row = namedtuple('Row', cols)
-        else:
-          row = Row._make(line)
-          if row.external_org_id.isdecimal():
-            cursor.execute("""
-        insert into organizations values(%s, %s, %s, %s, %s)
-        on conflict do nothing
-    """, (int(row.external_org_id), row.search_name, row.organization_type, row.description,
-                row.status_as_of_effective_date))
+    # Ids must be numeric; only the first row for each id is kept.
+    load_query(cursor, shadow, latest, columns,
+               where=lambda row: row.external_org_id.isdecimal(), unique=['id'])
+
+    swap_in_shadow(cursor, 'organizations')
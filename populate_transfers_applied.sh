@@ -4,10 +4,6 @@
 # events prior to March 4, 2021. Then run this to bring the history of transfer evaluations up to
 # date. Thereafter, just run update_transfers_applied.py daily.
 
-# For each daily file in downloads, in calendar order, update the transfers_applied table.
+# Replay each daily file in downloads, in calendar order, in a single process.
 
-for file in `ls -rt downloads/*ALL*`
-do
-  ls -l $file
-  update_transfers_applied.py $file
-done
\ No newline at end of file
+update_transfers_applied.py --replay `ls -rt downloads/*ALL*`
\ No newline at end of file
@@ -2,17 +2,21 @@
 """ Build a frequency distribution of posted dates for a transfers_applied CF query file.
     It's python so it can exceed Excel's and Numbers' row limits.
     Next: posted date by articulation and enrollment terms
+    The file may be a CSV query file or an archived (.parquet) snapshot.
 """
 
-import csv
 import datetime
 import sys
 import argparse
-from collections import namedtuple, defaultdict
+from collections import Counter, defaultdict
 from pathlib import Path
+from query_reader import query_date
+from snapshot_archive import open_snapshot
+from snapshot_schema import Schema
 
 parser = argparse.ArgumentParser('Update Transfers')
 parser.add_argument('-np', '--no_progress', action='store_true')
+parser.add_argument('-b', '--batch', action='store_true', help='count a batch of rows at a time')
 parser.add_argument('file', nargs='?')
 args = parser.parse_args()
 progress = not args.no_progress
@@ -43,38 +47,48 @@ print('Using:', the_file,
 
 posted_dates = defaultdict(int)
 
-# Progress indicators
-m = 0
-num_records = len(open(the_file, encoding='ascii', errors='backslashreplace').readlines()) - 1
+with open_snapshot(the_file, columns=['sysdate', 'dst_institution', 'posted_date'],
+                   progress=progress, backend='arrow' if args.batch else 'stdlib') as reader:
+  headers = reader.headers
+  cols = [h for h in headers]
 
-with open(the_file, encoding='ascii', errors='backslashreplace') as csv_file:
-  reader = csv.reader(csv_file)
-  for line in reader:
-    if reader.line_num == 1:
-      headers = [h.lower().replace(' ', '_') for h in line]
-      cols = [h for h in headers]
-
-      values_added = None
-      Row = namedtuple('Row', headers)
-    else:
-      if reader.line_num == 2 and 'sysdate' in cols:
+  if args.batch:
+    # Count (institution, posted_date) pairs a batch at a time; convert each distinct date once
+    pairs = Counter()
+    for batch in reader.batches():
+      if 'sysdate' in cols and reader.num_records == len(batch['sysdate']) and batch['sysdate']:
+        file_date = query_date(batch['sysdate'][0])
+        iso_file_date = file_date.strftime('%Y-%m-%d')
+      pairs.update(zip(batch['dst_institution'], batch['posted_date']))
+    for (dst_institution, posted), count in pairs.items():
+      if posted_date := query_date(posted):
+        posted_date = posted_date.strftime('%Y-%m-%d')
+        posted_dates[(dst_institution, posted_date)] += count
+        posted_dates['total', posted_date] += count
+    num_invalid = reader.num_invalid
+  else:
+    values_added = None
+    num_invalid = 0
+    schema = Schema(headers, ['sysdate', 'dst_institution', 'posted_date'],
+                    converters={'posted_date': query_date})
+    for line in reader:
+      if (row := schema.decode(line)) is None:
+        num_invalid += 1
+        continue
+      if reader.num_records == 1 and row.sysdate is not None:
         # SYSDATE is available: substitute it for file_date
-        mo, da, yr = [int(x) for x in line[-1].split('/')]
-        file_date = datetime.datetime(yr, mo, da)
+        file_date = query_date(row.sysdate)
         iso_file_date = file_date.strftime('%Y-%m-%d')
-      m += 1
-      if progress:
-        print(f'  {m:06,}/{num_records:06,}\r', end='', file=sys.stderr)
-      row = Row._make(line)
 
-      if '/' in row.posted_date:
-        mo, da, yr = row.posted_date.split('/')
-        posted_date = datetime.date(int(yr), int(mo), int(da)).strftime('%Y-%m-%d')
+      if posted_date := row.posted_date:
+        posted_date = posted_date.strftime('%Y-%m-%d')
         posted_dates[(row.dst_institution, posted_date)] += 1
         posted_dates['total', posted_date] += 1
       else:
         pass
 
+if num_invalid:
+  print(f'{num_invalid:,} records with the wrong number of fields skipped', file=sys.stderr)
 
 with open('posted_dates/' + iso_file_date, 'w') as report:
   print(iso_file_date, file=report)
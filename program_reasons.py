@@ -1,43 +1,46 @@
 #! /usr/local/bin/python3
 """Build the program_reasons table."""
 
-import csv
 import psycopg
 
-from collections import namedtuple
-from pathlib import Path
+from bulk_loader import load_query
+from timeline_utils import shadow_name, swap_in_shadow
 
 
+# longest_description()
+# -------------------------------------------------------------------------------------------------
+def longest_description(row) -> str:
+  """The longest of a reason's short, regular, and long descriptions."""
+  description = row.short_description
+  if len(row.description) > len(description):
+    description = row.description
+  if len(row.long_description) > len(description):
+    description = row.long_description
+  return description
+
+
+columns = {'institution': lambda row: row.setid[0:3],
+           'program_action': 'program_action',
+           'action_reason': 'action_reason',
+           'description': longest_description
+           }
+
 with psycopg.connect('dbname=cuny_transfers') as conn:
-  conn.execute("""
-    drop table if exists program_reasons;
-    create table program_reasons (
-    institution text,
-    program_action text,
-    action_reason text,
-    description text,
-    primary key (institution, program_action, action_reason)
-    );
-    """)
-  with Path('./queries/PROG_REASON_TBL.csv').open() as reason_file:
-    reader = csv.reader(reason_file)
-    for line in reader:
-      if reader.line_num == 1:
-        cols = [col.lower().replace(' ', '_') for col in line]
-        Row = namedtuple('Row', cols)
-      else:
-        row = Row._make(line)
-        if row.setid.startswith('GRD') or row.setid.startswith('UAC') or row.status != 'A':
-          continue
-        description = row.short_description
-        if len(row.description) > len(description):
-          description = row.description
-        if len(row.long_description) > len(description):
-          description = row.long_description
-        institution = row.setid[0:3]
-        conn.execute(f"""
-        insert into program_reasons values('{institution}',
-                                           '{row.program_action}',
-                                           '{row.action_reason}',
-                                           '{description}')
-        """)
+  with conn.cursor() as cursor:
+    # Build the new table as a shadow, and swap it in when it's complete.
+    shadow = shadow_name('program_reasons')
+    cursor.execute(f"""
+      drop table if exists {shadow};
+      create table {shadow} (
+      institution text,
+      program_action text,
+      action_reason text,
+      description text,
+      primary key (institution, program_action, action_reason)
+      );
+      """)
+    load_query(cursor, shadow, './queries/PROG_REASON_TBL.csv', columns,
+               where=lambda row: not (row.setid.startswith('GRD') or row.setid.startswith('UAC')
+                                      or row.status != 'A'))
+
+    swap_in_shadow(cursor, 'program_reasons')
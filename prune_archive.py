@@ -1,23 +1,57 @@
 #! /usr/local/bin/python3
-"""Remove queries from the archive that are older than the most-recently-archived set."""
+"""Remove old days from the query archive.
+
+Manifests for days more than --days (default 180) before the latest archived day are deleted,
+along with the chunks that no remaining manifest uses. Query files left in the archive directory
+from before it was a chunk store are deleted if they are older than the most-recently-archived set.
+"""
+
+import argparse
+import datetime
 
-from datetime import date
 from pathlib import Path
+from query_archive import archive_dir, archived_days, manifest_path, read_manifest
+
+parser = argparse.ArgumentParser('Prune query archive')
+parser.add_argument('-d', '--days', type=int, default=180)
+args = parser.parse_args()
 
-archive_dir = Path('./query_archive')
 assert archive_dir.is_dir(), './query_archive not here.'
+
+# Old days, and the chunks no longer used
+if days := archived_days():
+  cutoff = days[-1] - datetime.timedelta(days=args.days)
+  print('latest archived day is', days[-1])
+  for day in days:
+    if day < cutoff:
+      manifest_path(day).unlink()
+      print(f'{day} deleted')
+  in_use = {chunk_hash
+            for day in archived_days()
+            for entry in read_manifest(day).values()
+            for chunk_hash in entry['chunks']}
+  num_chunks = num_bytes = 0
+  for chunk_file in Path(archive_dir, 'chunks').glob('*/*'):
+    if chunk_file.name not in in_use:
+      num_chunks += 1
+      num_bytes += chunk_file.stat().st_size
+      chunk_file.unlink()
+  print(f'{num_chunks:,} unused chunks ({num_bytes:,} bytes) deleted')
+
+# Query files from the old archive
 latest = None
 for query_file in archive_dir.glob('*.csv'):
   if latest is None or query_file.stat().st_mtime > latest:
     latest = query_file.stat().st_mtime
 
-print('latest query set date is', date.fromtimestamp(latest))
+if latest is not None:
+  print('latest query set date is', datetime.date.fromtimestamp(latest))
 
-latest_date = date.fromtimestamp(latest)
-for victim in archive_dir.glob('*.csv'):
-  if (diff := (latest_date - date.fromtimestamp(victim.stat().st_mtime)).days) > 0:
-    s = 's' if diff != 1 else ''
-    print(f'{victim.name:40} was {diff:3} day{s} older than {latest_date}')
-    victim.unlink()
-  else:
-    print(f'{victim.name:40} LIVES')
+  latest_date = datetime.date.fromtimestamp(latest)
+  for victim in archive_dir.glob('*.csv'):
+    if (diff := (latest_date - datetime.date.fromtimestamp(victim.stat().st_mtime)).days) > 0:
+      s = 's' if diff != 1 else ''
+      print(f'{victim.name:40} was {diff:3} day{s} older than {latest_date}')
+      victim.unlink()
+    else:
+      print(f'{victim.name:40} LIVES')
@@ -0,0 +1,192 @@
+#! /usr/local/bin/python3
+"""Deduplicating, content-addressed archive of superseded query files.
+
+Each archived query file is split into content-defined chunks, and only the chunks that are not
+already in the store are saved, compressed, under query_archive/chunks/, named by their SHA-256
+hash. A manifest for each day (query_archive/manifests/<YYYY-MM-DD>.json) lists, for each query
+archived that day, its size, modification time, content hash, and chunk hashes. Consecutive days'
+queries are mostly identical, so they share most of their chunks, and months of history take about
+as much space as a few compressed copies.
+
+Chunk boundaries are chosen by content, not by position: a chunk ends after a line whose CRC-32
+has its low chunk_bits bits all zero (subject to min_chunk and max_chunk bytes), so inserting or
+deleting rows changes only the chunks around the change and the rest still match earlier days'.
+
+Usage:
+  query_archive.py [-d YYYY-MM-DD] file ...     # Archive files (default day: each file's mtime).
+                                                # YYYY-MM-DD.NAME.csv files from the old archive
+                                                # are archived as NAME.csv on that day.
+  query_archive.py -l                           # List the archived days and their queries
+  query_archive.py -r YYYY-MM-DD [-o dir]       # Reconstruct a day's queries (default: ./restored)
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+import zlib
+
+from pathlib import Path
+
+archive_dir = Path('./query_archive')
+
+# Content-defined chunking parameters: about 16 KiB + 256 lines per chunk
+chunk_bits = 8
+min_chunk = 0x4000
+max_chunk = 0x100000
+
+
+# chunks()
+# -------------------------------------------------------------------------------------------------
+def chunks(path):
+  """Generate the content-defined chunks of a file, as bytes."""
+  mask = (1 << chunk_bits) - 1
+  with open(path, 'rb') as query_file:
+    lines = []
+    size = 0
+    for line in query_file:
+      lines.append(line)
+      size += len(line)
+      if size >= max_chunk or (size >= min_chunk and zlib.crc32(line) & mask == 0):
+        yield b''.join(lines)
+        lines = []
+        size = 0
+    if lines:
+      yield b''.join(lines)
+
+
+# chunk_path()
+# -------------------------------------------------------------------------------------------------
+def chunk_path(chunk_hash: str, store: Path = archive_dir) -> Path:
+  """Where a chunk is stored."""
+  return Path(store, 'chunks', chunk_hash[0:2], chunk_hash)
+
+
+# manifest_path()
+# -------------------------------------------------------------------------------------------------
+def manifest_path(day: datetime.date, store: Path = archive_dir) -> Path:
+  """Where a day's manifest is stored."""
+  return Path(store, 'manifests', f'{day.isoformat()}.json')
+
+
+# read_manifest()
+# -------------------------------------------------------------------------------------------------
+def read_manifest(day: datetime.date, store: Path = archive_dir) -> dict:
+  """A day's manifest entries, keyed by query file name."""
+  try:
+    return json.loads(manifest_path(day, store).read_text())
+  except FileNotFoundError:
+    return dict()
+
+
+# write_atomically()
+# -------------------------------------------------------------------------------------------------
+def write_atomically(path: Path, data: bytes):
+  """Write a file so that readers see either its old contents or all of its new ones."""
+  path.parent.mkdir(parents=True, exist_ok=True)
+  temp_path = path.with_suffix('.tmp')
+  temp_path.write_bytes(data)
+  temp_path.replace(path)
+
+
+# archive_query()
+# -------------------------------------------------------------------------------------------------
+def archive_query(path, day: datetime.date = None, name: str = None,
+                  store: Path = archive_dir) -> dict:
+  """Add a query file to the store and to a day's manifest; return its manifest entry.
+
+  The day defaults to the file's modification date, and the name to the file's name.
+  """
+  path = Path(path)
+  stats = path.stat()
+  day = day or datetime.date.fromtimestamp(stats.st_mtime)
+  file_hash = hashlib.sha256()
+  chunk_hashes = []
+  new_bytes = 0
+  for chunk in chunks(path):
+    file_hash.update(chunk)
+    chunk_hash = hashlib.sha256(chunk).hexdigest()
+    chunk_hashes.append(chunk_hash)
+    if not (stored := chunk_path(chunk_hash, store)).exists():
+      compressed = zlib.compress(chunk)
+      write_atomically(stored, compressed)
+      new_bytes += len(compressed)
+
+  entry = {'size': stats.st_size,
+           'mtime': stats.st_mtime,
+           'content_hash': file_hash.hexdigest(),
+           'new_bytes': new_bytes,
+           'chunks': chunk_hashes}
+  manifest = read_manifest(day, store)
+  manifest[name or path.name] = entry
+  write_atomically(manifest_path(day, store),
+                   json.dumps(manifest, indent=2, sort_keys=True).encode())
+  return entry
+
+
+# restore_query()
+# -------------------------------------------------------------------------------------------------
+def restore_query(name: str, day: datetime.date, dest_dir, store: Path = archive_dir) -> Path:
+  """Reconstruct a query file as it was archived on a day; return its path.
+
+  The file gets its original modification time. Raises KeyError if the query was not archived that
+  day, and ValueError if the reconstructed contents do not match the archived content hash.
+  """
+  entry = read_manifest(day, store)[name]
+  dest_path = Path(dest_dir, name)
+  dest_path.parent.mkdir(parents=True, exist_ok=True)
+  temp_path = dest_path.with_suffix('.tmp')
+  file_hash = hashlib.sha256()
+  with open(temp_path, 'wb') as query_file:
+    for chunk_hash in entry['chunks']:
+      chunk = zlib.decompress(chunk_path(chunk_hash, store).read_bytes())
+      file_hash.update(chunk)
+      query_file.write(chunk)
+  if file_hash.hexdigest() != entry['content_hash']:
+    temp_path.unlink()
+    raise ValueError(f'{name} for {day} does not match its content hash')
+  os.utime(temp_path, (entry['mtime'], entry['mtime']))
+  temp_path.replace(dest_path)
+  return dest_path
+
+
+# archived_days()
+# -------------------------------------------------------------------------------------------------
+def archived_days(store: Path = archive_dir) -> list:
+  """The days that have manifests, in order."""
+  return sorted(datetime.date.fromisoformat(path.stem)
+                for path in Path(store, 'manifests').glob('*.json'))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser('Query archive')
+  parser.add_argument('-d', '--day', type=datetime.date.fromisoformat)
+  parser.add_argument('-l', '--list', action='store_true')
+  parser.add_argument('-r', '--restore', type=datetime.date.fromisoformat)
+  parser.add_argument('-o', '--output_dir', default='./restored')
+  parser.add_argument('files', nargs='*')
+  args = parser.parse_args()
+
+  if args.list:
+    for day in archived_days():
+      manifest = read_manifest(day)
+      print(f'{day}  {", ".join(sorted(manifest.keys()))}')
+
+  if args.restore:
+    if not (manifest := read_manifest(args.restore)):
+      sys.exit(f'Nothing archived on {args.restore}')
+    for name in sorted(manifest.keys()):
+      print(restore_query(name, args.restore, args.output_dir))
+
+  for file in args.files:
+    path = Path(file)
+    day, name = args.day, path.name
+    # Files from the old archive are named YYYY-MM-DD.NAME.csv
+    if match := re.match(r'(\d{4}-\d{2}-\d{2})\.(.+)$', name):
+      day = day or datetime.date.fromisoformat(match[1])
+      name = match[2]
+    entry = archive_query(path, day, name)
+    print(f'{name:40} {entry["size"]:14,} bytes; {entry["new_bytes"]:12,} bytes added')
@@ -0,0 +1,282 @@
+#! /usr/local/bin/python3
+"""Single-pass reader for CUNYfirst query (CSV) files.
+
+The query files are large, so they are read just once: progress is reported as the fraction of the
+file's bytes consumed so far rather than as a fraction of a line count obtained by reading the file
+an extra time. Rows are decoded lazily, one physical line at a time, so memory use does not depend
+on the size of the file.
+
+Usage:
+  with QueryReader(the_file, progress=True) as reader:
+    Row = namedtuple('Row', reader.headers)
+    for line in reader:
+      row = Row._make(line)
+
+A reader can be limited to the records between two byte offsets (which must be record boundaries)
+so that separate processes can parse different parts of the same file.
+
+There are two backends for tokenizing the file: the standard library's csv module ('stdlib', the
+default), and pyarrow's multithreaded CSV reader ('arrow'), which parses blocks of the file into
+columns. Values are decoded with the same encoding and error handling either way. The arrow
+backend is used only if pyarrow is installed, and only for whole files (not start/end parts); the
+stdlib backend is used otherwise. batches() yields dicts of column lists, batch_size records at a
+time, from either backend; iterating over the reader yields rows as before.
+
+Records with the wrong number of fields are handled the same way by both backends: iterating over
+the reader yields them like any other row (the arrow backend yields them after the rows of the
+batch they were parsed with), so the caller can account for them; batches() skips them, because
+they do not fit into columns, and counts them in num_invalid.
+"""
+
+import codecs
+import csv
+import datetime
+import hashlib
+import io
+import sys
+
+from functools import lru_cache
+from pathlib import Path
+
+try:
+  import pyarrow as pa
+  import pyarrow.compute as pc
+  import pyarrow.csv as pa_csv
+except ImportError:
+  pa = None
+
+backends = ['stdlib', 'arrow']
+
+
+class QueryReader:
+  """Iterate over the data rows of a query file as lists of strings.
+
+  headers:      Column names, lower case with spaces and hyphens replaced by underscores.
+  num_lines:    Physical lines read so far, including the header line.
+  num_records:  Data rows yielded so far. (Differs from num_lines when fields contain newlines.)
+  num_invalid:  Records skipped by batches() because they had the wrong number of fields.
+  backend:      The backend actually in use. (With the arrow backend, num_lines counts the header
+                plus one line per record.)
+  """
+
+  def __init__(self, path, encoding: str = 'ascii', errors: str = 'backslashreplace',
+               progress: bool = False, start: int = None, end: int = None,
+               backend: str = 'stdlib', batch_size: int = 0x10000):
+    """Open the file and read its header row.
+
+    If start is given, skip to that offset after reading the header. If end is given, stop there.
+    Both offsets must be record boundaries; see record_boundaries().
+    """
+    self.path = Path(path)
+    self.file_size = self.path.stat().st_size
+    self.encoding = encoding
+    self.errors = errors
+    self.progress = progress
+    self.offset = 0
+    self.start = 0
+    self.end = self.file_size if end is None else end
+    self.num_lines = 0
+    self.num_records = 0
+    self.num_invalid = 0
+    self._invalid_rows = []
+    self._file = open(self.path, 'rb')
+    self._reader = csv.reader(self._decoded_lines())
+    try:
+      header_line = next(self._reader)
+    except StopIteration:
+      header_line = []
+    self.headers = [h.lower().replace(' ', '_').replace('-', '_') for h in header_line]
+    self.start = self.offset
+    if start is not None and start > self.offset:
+      self._file.seek(start)
+      self.offset = self.start = start
+    self.batch_size = batch_size
+    self.backend = 'stdlib'
+    if backend == 'arrow' and pa is not None and start is None and end is None:
+      self.backend = 'arrow'
+    self._codec = codecs.lookup(encoding).name
+
+  def _decoded_lines(self):
+    """Decode the file one physical line at a time, keeping track of the byte offset."""
+    for raw_line in self._file:
+      if self.offset >= self.end:
+        return
+      self.offset += len(raw_line)
+      self.num_lines += 1
+      yield raw_line.decode(self.encoding, errors=self.errors)
+
+  def _show_progress(self, end: str = ''):
+    """Records read and percent of the file consumed, on one self-overwriting line."""
+    span = self.end - self.start
+    fraction = (self.offset - self.start) / span if span > 0 else 1.0
+    print(f'\r    {self.num_records:9,} records {fraction:6.1%}', end=end, file=sys.stderr)
+
+  def __iter__(self):
+    """Yield each data row."""
+    if self.backend == 'arrow':
+      lines = self._arrow_lines()
+    else:
+      lines = self._reader
+    for line in lines:
+      self.num_records += 1
+      if self.progress and self.num_records % 1000 == 0:
+        self._show_progress()
+      yield line
+    if self.progress:
+      self._show_progress(end='\n')
+
+  def batches(self):
+    """Yield dicts mapping each header to a list of up to batch_size values."""
+    if self.backend == 'arrow':
+      for batch in self._arrow_batches():
+        self.num_invalid += len(self._take_invalid_rows())
+        self.num_records += len(batch[self.headers[0]]) if self.headers else 0
+        if self.progress:
+          self._show_progress()
+        yield batch
+      self.num_invalid += len(self._take_invalid_rows())
+    else:
+      lines = []
+      for line in self._reader:
+        if len(line) != len(self.headers):
+          self.num_invalid += 1
+          continue
+        self.num_records += 1
+        lines.append(line)
+        if len(lines) == self.batch_size:
+          if self.progress:
+            self._show_progress()
+          yield dict(zip(self.headers, map(list, zip(*lines))))
+          lines = []
+      if lines:
+        yield dict(zip(self.headers, map(list, zip(*lines))))
+    if self.progress:
+      self._show_progress(end='\n')
+
+  def _arrow_batches(self):
+    """Parse the file's data rows with pyarrow; yield dicts of decoded column lists.
+
+    Records with the wrong number of fields are set aside for _take_invalid_rows() instead of
+    raising ArrowInvalid.
+    """
+    def set_aside(invalid_row):
+      self._invalid_rows.append(invalid_row.text)
+      return 'skip'
+
+    source = pa.OSFile(str(self.path))
+    reader = pa_csv.open_csv(source,
+                             read_options=pa_csv.ReadOptions(column_names=self.headers,
+                                                             skip_rows=1),
+                             parse_options=pa_csv.ParseOptions(newlines_in_values=True,
+                                                               invalid_row_handler=set_aside),
+                             convert_options=pa_csv.ConvertOptions(
+                               column_types={header: pa.binary() for header in self.headers},
+                               strings_can_be_null=False))
+    with source:
+      for record_batch in reader:
+        for first in range(0, record_batch.num_rows, self.batch_size):
+          batch = record_batch.slice(first, self.batch_size)
+          self.offset = min(source.tell(), self.end)
+          self.num_lines += batch.num_rows
+          yield {header: self._decode(column) for header, column in zip(self.headers,
+                                                                         batch.columns)}
+
+  def _arrow_lines(self):
+    """Yield the rows of the arrow backend's batches, each batch followed by any set-aside rows."""
+    for batch in self._arrow_batches():
+      yield from zip(*batch.values())
+      yield from self._take_invalid_rows()
+    yield from self._take_invalid_rows()
+
+  def _take_invalid_rows(self) -> list:
+    """The records the arrow backend has set aside since the last call, as lists of strings."""
+    texts, self._invalid_rows = self._invalid_rows, []
+    self.num_lines += len(texts)
+    return [line for text in texts for line in csv.reader(io.StringIO(text))]
+
+  def _decode(self, column) -> list:
+    """Decode a column of bytes values like _decoded_lines() does, using pyarrow where possible.
+
+    A column that is valid UTF-8 (and, for ascii files, contains only ASCII) is converted in one
+    step; otherwise each value is decoded with the reader's encoding and error handler.
+    """
+    if self._codec in ['utf-8', 'ascii']:
+      try:
+        strings = column.cast(pa.string())
+        if self._codec == 'utf-8' or pc.all(pc.string_is_ascii(strings)).as_py() is not False:
+          return strings.to_pylist()
+      except pa.ArrowInvalid:
+        pass
+    return [value.decode(self.encoding, errors=self.errors) for value in column.to_pylist()]
+
+  def close(self):
+    """Close the underlying file."""
+    self._file.close()
+
+  def __enter__(self):
+    """Context manager entry."""
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    """Close the file on context exit."""
+    self.close()
+
+
+# record_boundaries()
+# -------------------------------------------------------------------------------------------------
+def record_boundaries(path, num_chunks: int, block_size: int = 0x100000) -> list:
+  """Offsets that divide a query file's records into (roughly) num_chunks equal-sized parts.
+
+  The first offset is the start of the first record after the header line; the last is the size of
+  the file. Quoted fields may contain newlines, so a line end is a record boundary only if an even
+  number of double quotes precedes it. ("" inside a quoted field counts twice.) Quotes are counted
+  in large blocks until a target offset is near, then line by line until a boundary is found.
+  """
+  path = Path(path)
+  file_size = path.stat().st_size
+  with open(path, 'rb') as query_file:
+    offset = len(query_file.readline())
+    boundaries = [offset]
+    in_quotes = False
+    for chunk_num in range(1, num_chunks):
+      target = file_size * chunk_num // num_chunks
+      while target - offset > block_size:
+        block = query_file.read(block_size)
+        offset += len(block)
+        in_quotes ^= bool(block.count(b'"') & 1)
+      for raw_line in iter(query_file.readline, b''):
+        offset += len(raw_line)
+        in_quotes ^= bool(raw_line.count(b'"') & 1)
+        if offset >= target and not in_quotes:
+          break
+      if boundaries[-1] < offset < file_size:
+        boundaries.append(offset)
+  boundaries.append(file_size)
+  return boundaries
+
+
+# query_date()
+# -------------------------------------------------------------------------------------------------
+@lru_cache(maxsize=0x1000)
+def query_date(value) -> datetime.date:
+  """Date from a query file's MM/DD/YYYY string (or an archived snapshot's date); None if none.
+
+  A query file has only a few hundred distinct dates, so conversions are cached.
+  """
+  if value is None or isinstance(value, datetime.date):
+    return value
+  if '/' not in value:
+    return None
+  mo, da, yr = value.split('/')
+  return datetime.date(int(yr), int(mo), int(da))
+
+
+# content_hash()
+# -------------------------------------------------------------------------------------------------
+def content_hash(path, block_size: int = 0x100000) -> str:
+  """SHA-256 hex digest of a file's contents, read sequentially in large blocks."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as query_file:
+    while block := query_file.read(block_size):
+      digest.update(block)
+  return digest.hexdigest()
@@ -1,14 +1,40 @@
 #! /usr/local/bin/python3
-"""Build the registrations table."""
+"""Build or update the registrations table.
 
-import csv
+The registrations table is partitioned by term, one partition (registrations_<term>) per term. The
+registration_terms table records a fingerprint of each term's rows as of the last time its
+partition was loaded. On a refresh, the rows of each open term are COPYed into an unlogged staging
+table while their fingerprints are computed; then only the terms whose fingerprints changed get
+new partitions, which are swapped in for the old ones with detach/attach, in one transaction.
+
+Terms that started more than two years ago are closed: once loaded, their rows in the query file
+are ignored and their partitions are never reloaded (unless the table is rebuilt with --rebuild).
+
+registration_summary has one row per (student, institution, term) with the first and last add and
+drop dates and their counts, which is all the timeline statistics need. The summary rows for a term
+are recomputed from the staged rows whenever the term's partition is reloaded, and dropped with it.
+
+A rebuild loads shadow copies of registrations (with all its partitions), registration_terms, and
+registration_summary, which are swapped in for the old tables when they are complete.
+"""
+
+import argparse
+import hashlib
 import psycopg
-import sys
 
-from collections import namedtuple
-from datetime import datetime
+from bulk_loader import copy_rows
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from psycopg.rows import namedtuple_row
+from query_reader import QueryReader
+from timeline_utils import shadow_name, swap_in_shadow
 
-show_progress = len(sys.argv) > 1
+parser = argparse.ArgumentParser('Registrations table')
+parser.add_argument('-p', '--progress', action='store_true')
+parser.add_argument('-r', '--rebuild', action='store_true')
+parser.add_argument('-a', '--arrow', action='store_true', help='tokenize the query with pyarrow')
+args = parser.parse_args()
+show_progress = args.progress
 start_time = datetime.now()
 
 # Set up registrations column names
@@ -26,64 +52,204 @@ csv_to_db = {'id': 'student_id',
              'academic_group': 'academic_group',
              'last_enrollment_action_process': 'process_code'
              }
+db_cols = list(csv_to_db.values())
+
+# How long after a term starts before its registrations are considered final
+closed_after = timedelta(days=730)
+
+
+# summary_ddl()
+# -------------------------------------------------------------------------------------------------
+def summary_ddl(table: str) -> str:
+  """Create a registration_summary table with the given name."""
+  return f"""
+  create table {table} (
+  student_id               integer,
+  institution              text,
+  term                     integer,
+  first_add                date,
+  last_add                 date,
+  num_adds                 integer,
+  first_drop               date,
+  last_drop                date,
+  num_drops                integer,
+  primary key (institution, term, student_id)
+  );
+  """
+
+
+# summary_select()
+# -------------------------------------------------------------------------------------------------
+def summary_select(source: str) -> str:
+  """Select the registration_summary rows for the registrations in source."""
+  return f"""
+  select student_id, institution, term,
+         min(add_date), max(add_date), count(add_date),
+         min(drop_date), max(drop_date), count(drop_date)
+    from {source}
+  """
+
+
+# term_start()
+# -------------------------------------------------------------------------------------------------
+def term_start(term: int) -> date:
+  """First day of the month a CF term code (1YYM) refers to."""
+  year = 1900 + 100 * int(term / 1000) + int(term / 10) % 100
+  return date(year, term % 10, 1)
+
 
-# Create the table
 with psycopg.connect('dbname=cuny_transfers') as conn:
-  with conn.cursor() as cursor:
+  with conn.cursor(row_factory=namedtuple_row) as cursor:
+
+    # Create the tables if they don't exist yet, aren't partitioned yet, or a rebuild is requested
     cursor.execute("""
-    drop table if exists registrations;
-    create table registrations (
-    student_id               integer,
-    career                   text,
-    institution              text,
-    term                     integer,
-    session                  text,
-    enrollment_status        text,
-    enrollment_reason        text,
-    last_enrollment_action   text,
-    add_date                 date default null,
-    drop_date                date default null,
-    requirement_designation  text,
-    academic_group           text,
-    process_code             text
-    )
+    select count(*) as num_tables
+      from pg_partitioned_table p, pg_class c
+     where c.oid = p.partrelid
+       and c.relname = 'registrations'
     """)
+    rebuild = args.rebuild or cursor.fetchone().num_tables == 0
+    if rebuild:
+      target = shadow_name('registrations')
+      terms_table = shadow_name('registration_terms')
+      summary_table = shadow_name('registration_summary')
+      cursor.execute(f"""
+      drop table if exists {target};
+      drop table if exists {terms_table};
+      drop table if exists {summary_table};
+      create table {target} (
+      student_id               integer,
+      career                   text,
+      institution              text,
+      term                     integer,
+      session                  text,
+      enrollment_status        text,
+      enrollment_reason        text,
+      last_enrollment_action   text,
+      add_date                 date default null,
+      drop_date                date default null,
+      requirement_designation  text,
+      academic_group           text,
+      process_code             text
+      ) partition by list (term);
 
-    # Populate the table
+      create table {terms_table} (
+      term                     integer primary key,
+      row_hash                 text,
+      num_rows                 integer,
+      loaded_at                timestamp
+      );
+      """)
+      cursor.execute(summary_ddl(summary_table))
+    else:
+      target = 'registrations'
+      terms_table = 'registration_terms'
+      summary_table = 'registration_summary'
+      # Summarize all the terms already loaded if there is no summary table yet
+      cursor.execute("select to_regclass('registration_summary') is null as is_missing")
+      if cursor.fetchone().is_missing:
+        cursor.execute(summary_ddl(summary_table))
+        cursor.execute(f"""
+        insert into {summary_table}
+        {summary_select(target)}
+        group by student_id, institution, term
+        """)
+
+    cursor.execute(f"""
+    drop table if exists registrations_staging;
+    create unlogged table registrations_staging (like {target} including defaults);
+    """)
+
+    cursor.execute(f'select term, row_hash from {terms_table}')
+    old_hashes = {row.term: row.row_hash for row in cursor}
+    closed_terms = {term for term in old_hashes.keys()
+                    if term_start(term) + closed_after < date.today()}
+
+    # Stage the rows for open terms, and fingerprint each term's rows. A term's fingerprint is the
+    # sum of its rows' digests, so it does not depend on the order of rows in the query file.
     # One row per (student, institution, term, session) for each registraton date and add/drop
     # indicator.
-    total_lines = sum(1 for line in open('queries/CV_QNS_STUDENT_SUMMARY.csv'))
-    with open('queries/CV_QNS_STUDENT_SUMMARY.csv') as csv_file:
-      reader = csv.reader(csv_file)
-
-      counter = 0
-      this_record_key = None
-      registrations = None
-
-      for line in reader:
-        if reader.line_num == 1:
-          cols = [col.lower().replace(' ', '_').replace('-', '_') for col in line]
-          Row = namedtuple('Row', cols)
-        else:
-          if show_progress:
-            print(f'\r{reader.line_num:,}/{total_lines:,}', end='')
-          row = Row._make(line)
-          if row.career.startswith('U'):
-            counter += 1
-            placeholders = ''
-            column_names = []
-            column_values = []
-            for line_key, row_key in csv_to_db.items():
-              if row_key.endswith('_date') and not line[cols.index(line_key)]:
-                continue
-              placeholders += ',%s '
-              column_names.append(row_key)
-              column_values.append(line[cols.index(line_key)].strip())
-
-            placeholders = placeholders.strip(', ')
-            column_names = ', '.join(column_names)
-            cursor.execute(f"""
-            insert into registrations ({column_names}) values ({placeholders})
-            """, column_values)
-
-print(f'\n{(datetime.now() - start_time).seconds} seconds\n{counter:,} records')
+    term_sums = defaultdict(int)
+    term_counts = defaultdict(int)
+    counts = defaultdict(int)
+    with QueryReader('queries/CV_QNS_STUDENT_SUMMARY.csv', encoding='utf-8',
+                     progress=show_progress,
+                     backend='arrow' if args.arrow else 'stdlib') as reader:
+      cols = reader.headers
+      csv_indexes = [cols.index(csv_col) for csv_col in csv_to_db.keys()]
+      career_index = cols.index('career')
+      term_index = cols.index('term')
+
+      def staged_rows():
+        """Generate the values of the rows to stage, fingerprinting each term's rows."""
+        for line in reader:
+          if line[career_index].startswith('U'):
+            counts['records'] += 1
+            term = int(line[term_index])
+            if term in closed_terms:
+              counts['closed'] += 1
+              continue
+            values = [line[index].strip() for index in csv_indexes]
+            digest = hashlib.md5('\x1f'.join(values).encode()).digest()
+            term_sums[term] = (term_sums[term] + int.from_bytes(digest, 'big')) % (1 << 128)
+            term_counts[term] += 1
+            yield values
+
+      # Missing dates are staged as NULL
+      copy_rows(cursor, 'registrations_staging', db_cols, staged_rows())
+
+    new_hashes = {term: f'{term_sum:032x}' for term, term_sum in term_sums.items()}
+    changed_terms = sorted(term for term, term_hash in new_hashes.items()
+                           if old_hashes.get(term) != term_hash)
+    vanished_terms = sorted(term for term in old_hashes.keys()
+                            if term not in new_hashes and term not in closed_terms)
+
+    # Swap in a new partition, and new summary rows, for each changed term
+    for term in changed_terms:
+      partition = f'{target}_{term}'
+      cursor.execute(f"""
+      drop table if exists {partition}_new;
+      create table {partition}_new (like {target} including defaults);
+      insert into {partition}_new select * from registrations_staging where term = {term};
+      alter table {partition}_new add constraint {partition}_term check (term = {term});
+      """)
+      if term in old_hashes:
+        cursor.execute(f"""
+        alter table {target} detach partition {partition};
+        drop table {partition};
+        """)
+      cursor.execute(f"""
+      alter table {partition}_new rename to {partition};
+      alter table {target} attach partition {partition} for values in ({term});
+      """)
+      cursor.execute(f"""
+      delete from {summary_table} where term = {term};
+      insert into {summary_table}
+      {summary_select('registrations_staging')}
+       where term = {term}
+       group by student_id, institution, term;
+      """)
+      cursor.execute(f"""
+      insert into {terms_table} values (%s, %s, %s, now())
+      on conflict (term) do update set row_hash = excluded.row_hash,
+                                       num_rows = excluded.num_rows,
+                                       loaded_at = excluded.loaded_at
+      """, (term, new_hashes[term], term_counts[term]))
+
+    # Drop partitions for open terms that are no longer in the query file
+    for term in vanished_terms:
+      cursor.execute(f'drop table if exists {target}_{term}')
+      cursor.execute(f'delete from {terms_table} where term = %s', (term, ))
+      cursor.execute(f'delete from {summary_table} where term = %s', (term, ))
+
+    cursor.execute('truncate registrations_staging')
+
+    if rebuild:
+      swap_in_shadow(cursor, 'registrations')
+      swap_in_shadow(cursor, 'registration_terms')
+      swap_in_shadow(cursor, 'registration_summary')
+
+print(f'\n{(datetime.now() - start_time).seconds} seconds\n{counts["records"]:,} records\n'
+      f'{len(changed_terms)} terms reloaded: {", ".join(str(t) for t in changed_terms)}\n'
+      f'{len(vanished_terms)} terms dropped; {len(closed_terms)} closed terms '
+      f'({counts["closed"]:,} records) skipped')
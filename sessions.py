@@ -17,58 +17,46 @@ Renaming CUNYfirst fields:
   Census Date             census_date
 
 """
-import csv
 import psycopg
 
-
-with open('./queries/QNS_CV_SESSION_TABLE.csv') as sess:
-  reader = csv.reader(sess)
-  with psycopg.connect('dbname=cuny_transfers') as conn:
-    with conn.cursor() as cursor:
-
-      cursor.execute("""
-      drop table if exists sessions;
-      create table sessions (
-      institution           text,
-      term                  integer,
-      session               text,
-      early_enrollment      date default null,
-      open_enrollment       date default null,
-      last_enrollment       date default null,
-      classes_start         date default null,
-      census_date           date default null,
-      classes_end           date default null,
-      primary key (institution, term, session)
-      )
-      """)
-
-      csv_to_db = {'first_date_to_enroll': 'early_enrollment',
-                   'open_enrollment_date': 'open_enrollment',
-                   'last_date_to_enroll': 'last_enrollment',
-                   'session_beginning_date': 'classes_start',
-                   'census_date': 'census_date',
-                   'session_end_date': 'classes_end'
-                   }
-
-      for line in reader:
-        if reader.line_num == 1:
-          cols = [c.lower().replace(' ', '_') for c in line]
-        else:
-          row = dict()
-          for index, value in enumerate(line):
-            row[cols[index]] = value
-          if row['career'].startswith('U'):
-            column_names = ['institution', 'term', 'session']
-            placeholders = '%s, %s, %s'
-            values = [row['institution'], row['term'], row['session']]
-            # Handle missing dates
-            for field in ['first_date_to_enroll', 'open_enrollment_date', 'last_date_to_enroll',
-                          'session_beginning_date', 'census_date', 'session_end_date']:
-                if row[field]:
-                  column_names.append(csv_to_db[field])
-                  placeholders += ', %s'
-                  values.append(row[field])
-            column_names = ', '.join(column_names)
-            cursor.execute(f"""
-            insert into sessions ({column_names}) values ({placeholders})
-            """, values)
+from bulk_loader import load_query
+from timeline_utils import shadow_name, swap_in_shadow
+
+# Table columns and the query columns they come from
+columns = {'institution': 'institution',
+           'term': 'term',
+           'session': 'session',
+           'early_enrollment': 'first_date_to_enroll',
+           'open_enrollment': 'open_enrollment_date',
+           'last_enrollment': 'last_date_to_enroll',
+           'classes_start': 'session_beginning_date',
+           'census_date': 'census_date',
+           'classes_end': 'session_end_date'
+           }
+
+with psycopg.connect('dbname=cuny_transfers') as conn:
+  with conn.cursor() as cursor:
+
+    # Build the new table as a shadow, and swap it in when it's complete.
+    shadow = shadow_name('sessions')
+    cursor.execute(f"""
+    drop table if exists {shadow};
+    create table {shadow} (
+    institution           text,
+    term                  integer,
+    session               text,
+    early_enrollment      date default null,
+    open_enrollment       date default null,
+    last_enrollment       date default null,
+    classes_start         date default null,
+    census_date           date default null,
+    classes_end           date default null,
+    primary key (institution, term, session)
+    )
+    """)
+
+    # Missing dates are loaded as NULL
+    load_query(cursor, shadow, './queries/QNS_CV_SESSION_TABLE.csv', columns,
+               where=lambda row: row.career.startswith('U'))
+
+    swap_in_shadow(cursor, 'sessions')
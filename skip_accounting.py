@@ -0,0 +1,95 @@
+#! /usr/local/bin/python3
+"""Count the rows a loader skips, by reason, and keep a few examples of each.
+
+A SkipAccount keeps a counter for each reason a row was skipped, and a reservoir sample of at most
+sample_size of the rows skipped for that reason, so every skipped row is equally likely to be kept
+no matter how many there are. The summary is a small dict (or JSON string) that is stored with the
+loader's update_history row instead of logging every skipped row.
+
+Reasons used by the transfers loaders:
+  not_posted        model_status is not Posted
+  after_cutoff      posted after the cutoff date (initialize_transfers_applied.py)
+  duplicate_key     primary key already in transfer_facts (or earlier in the same snapshot)
+  bad_date          posted_date is not a valid MM/DD/YYYY date
+  schema_mismatch   wrong number of fields, or a non-numeric id
+"""
+
+import json
+import random
+
+from collections import Counter
+
+
+class SkipAccount:
+  """Counters and reservoir samples of skipped rows, by reason."""
+
+  def __init__(self, sample_size: int = 5):
+    """Start with no skips."""
+    self.sample_size = sample_size
+    self.counts = Counter()
+    self.samples = dict()
+
+  def skip(self, reason: str, row):
+    """Count a skipped row, and maybe keep it as an example."""
+    self.counts[reason] += 1
+    samples = self.samples.setdefault(reason, [])
+    if len(samples) < self.sample_size:
+      samples.append([str(value) for value in row])
+    elif (index := random.randrange(self.counts[reason])) < self.sample_size:
+      samples[index] = [str(value) for value in row]
+
+  def add(self, reason: str, count: int):
+    """Count skipped rows that are not available to sample (e.g. conflicts found by the db)."""
+    if count > 0:
+      self.counts[reason] += count
+
+  def merge(self, other: 'SkipAccount'):
+    """Add the counts and samples of another account (e.g. from another process) to this one.
+
+    Each example kept is drawn from one account or the other in proportion to the number of rows
+    each skipped, so the merged sample is still a uniform sample of all the skipped rows.
+    """
+    for reason, other_count in other.counts.items():
+      mine = list(self.samples.get(reason, []))
+      theirs = list(other.samples.get(reason, []))
+      my_count = self.counts[reason]
+      merged = []
+      while len(merged) < self.sample_size and (mine or theirs):
+        if theirs and (not mine or random.randrange(my_count + other_count) >= my_count):
+          merged.append(theirs.pop(random.randrange(len(theirs))))
+          other_count -= 1
+        else:
+          merged.append(mine.pop(random.randrange(len(mine))))
+          my_count -= 1
+      self.samples[reason] = merged
+      self.counts[reason] += other.counts[reason]
+
+  @classmethod
+  def from_summary(cls, summary: dict, sample_size: int = 5) -> 'SkipAccount':
+    """An account with the counts and examples of a summary() (e.g. one saved as JSON)."""
+    account = cls(sample_size)
+    for reason, entry in summary.items():
+      account.counts[reason] = entry['count']
+      account.samples[reason] = [list(example.values()) if isinstance(example, dict) else example
+                                 for example in entry['examples']][:sample_size]
+    return account
+
+  @property
+  def total(self) -> int:
+    """Number of rows skipped for any reason."""
+    return sum(self.counts.values())
+
+  def summary(self, headers: list = None) -> dict:
+    """Counts and examples by reason. Examples are dicts if headers are given."""
+    return {reason: {'count': count,
+                     'examples': [dict(zip(headers, sample)) if headers else sample
+                                  for sample in self.samples.get(reason, [])]}
+            for reason, count in sorted(self.counts.items())}
+
+  def to_json(self, headers: list = None) -> str:
+    """The summary as a JSON string."""
+    return json.dumps(self.summary(headers))
+
+  def __str__(self):
+    """One line per reason."""
+    return '\n'.join(f'{reason}: {count:,}' for reason, count in sorted(self.counts.items()))
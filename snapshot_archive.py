@@ -0,0 +1,213 @@
+#! /usr/local/bin/python3
+"""Archive daily CV_QNS_TRNS_DTL_SRC_CLASS_ALL snapshots as compressed, typed Parquet files.
+
+Each snapshot in downloads/ is converted to snapshot_archive/<name>.parquet, with course ids, offer
+numbers, terms, and student ids stored as integers and dates as dates, and the manifest
+(snapshot_archive/manifest.json) records the source file's name, size, and content hash, the
+snapshot date (SYSDATE), and the number of rows. Snapshots whose contents are already in the
+archive are not converted again.
+
+Scripts that read snapshots use open_snapshot(), which returns an ArchiveReader for an archived
+(.parquet) snapshot and a QueryReader for a CSV one. An ArchiveReader reads only the columns it is
+asked for, and yields their values already converted (use query_date() for date columns).
+
+pyarrow is needed to create or read the archive, but not to read CSV snapshots.
+
+Usage:
+  snapshot_archive.py [snapshot ...]    # Default: every downloads/CV*ALL* file
+"""
+
+import argparse
+import datetime
+import json
+import sys
+
+from pathlib import Path
+from query_reader import QueryReader, content_hash
+
+try:
+  import pyarrow as pa
+  import pyarrow.csv as pa_csv
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = None
+
+archive_dir = Path('./snapshot_archive')
+manifest_file = Path(archive_dir, 'manifest.json')
+
+# Columns stored as integers; the dates are in MM/DD/YYYY form. All other columns are text.
+int_cols = ['student_id', 'enrollment_term', 'articulation_term', 'transfer_model_nbr',
+            'src_course_id', 'src_offer_nbr', 'dst_course_id', 'dst_offer_nbr']
+date_cols = ['posted_date', 'sysdate']
+
+
+# read_manifest()
+# -------------------------------------------------------------------------------------------------
+def read_manifest() -> dict:
+  """Manifest entries, keyed by archive file name."""
+  try:
+    return json.loads(manifest_file.read_text())
+  except FileNotFoundError:
+    return dict()
+
+
+# manifest_entry()
+# -------------------------------------------------------------------------------------------------
+def manifest_entry(path) -> dict:
+  """The manifest entry for an archived snapshot, or None if path is not in the archive."""
+  return read_manifest().get(Path(path).name)
+
+
+# archive_snapshot()
+# -------------------------------------------------------------------------------------------------
+def archive_snapshot(csv_path, file_hash: str = None) -> dict:
+  """Convert a CSV snapshot to Parquet; return its manifest entry (the caller saves it)."""
+  csv_path = Path(csv_path)
+  with QueryReader(csv_path) as reader:
+    headers = reader.headers
+  table = pa_csv.read_csv(csv_path,
+                          read_options=pa_csv.ReadOptions(column_names=headers, skip_rows=1),
+                          parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+                          convert_options=pa_csv.ConvertOptions(
+                            column_types={**{col: pa.string() for col in headers},
+                                          **{col: pa.int64() for col in int_cols
+                                             if col in headers},
+                                          **{col: pa.timestamp('s') for col in date_cols
+                                             if col in headers}},
+                            timestamp_parsers=['%m/%d/%Y'],
+                            strings_can_be_null=False))
+  for col in date_cols:
+    if col in headers:
+      index = headers.index(col)
+      table = table.set_column(index, col, table.column(col).cast(pa.date32()))
+
+  archive_path = Path(archive_dir, f'{csv_path.stem}.parquet')
+  temp_path = archive_path.with_suffix('.tmp')
+  pq.write_table(table, temp_path, compression='zstd')
+  temp_path.replace(archive_path)
+
+  snapshot_date = None
+  if 'sysdate' in headers and table.num_rows > 0:
+    snapshot_date = table.column('sysdate')[0].as_py()
+  if snapshot_date is None:
+    snapshot_date = datetime.date.fromtimestamp(csv_path.stat().st_mtime)
+  return {'source': csv_path.name,
+          'source_bytes': csv_path.stat().st_size,
+          'archive_bytes': archive_path.stat().st_size,
+          'content_hash': file_hash or content_hash(csv_path),
+          'snapshot_date': snapshot_date.isoformat(),
+          'num_rows': table.num_rows}
+
+
+# class ArchiveReader
+# -------------------------------------------------------------------------------------------------
+class ArchiveReader:
+  """Iterate over the rows of an archived snapshot, like a QueryReader.
+
+  Only the requested columns (those of them that the snapshot has) are read; headers lists them in
+  the order given. num_lines counts a header line plus one line per record, as if no field
+  contained a newline. num_invalid is always zero: every record has all the columns.
+  """
+
+  def __init__(self, path, columns: list = None, progress: bool = False):
+    """Open the Parquet file and select the columns to read."""
+    if pa is None:
+      sys.exit('pyarrow is needed to read archived snapshots')
+    self.path = Path(path)
+    self.progress = progress
+    self._file = pq.ParquetFile(self.path)
+    names = self._file.schema_arrow.names
+    self.headers = names if columns is None else [col for col in columns if col in names]
+    self.total_records = self._file.metadata.num_rows
+    self.num_lines = 1
+    self.num_records = 0
+    self.num_invalid = 0
+
+  def _show_progress(self, end: str = ''):
+    """Records read and percent of the records read, on one self-overwriting line."""
+    fraction = self.num_records / self.total_records if self.total_records else 1.0
+    print(f'\r    {self.num_records:9,} records {fraction:6.1%}', end=end, file=sys.stderr)
+
+  def __iter__(self):
+    """Yield each row as a tuple of values, one batch of rows at a time."""
+    for batch in self._file.iter_batches(columns=self.headers):
+      for line in zip(*[column.to_pylist() for column in batch.columns]):
+        self.num_records += 1
+        self.num_lines += 1
+        if self.progress and self.num_records % 1000 == 0:
+          self._show_progress()
+        yield line
+    if self.progress:
+      self._show_progress(end='\n')
+
+  def batches(self):
+    """Yield dicts mapping each header to a list of values, one Parquet batch at a time."""
+    for batch in self._file.iter_batches(columns=self.headers):
+      self.num_records += batch.num_rows
+      self.num_lines += batch.num_rows
+      if self.progress:
+        self._show_progress()
+      yield {header: column.to_pylist() for header, column in zip(self.headers, batch.columns)}
+    if self.progress:
+      self._show_progress(end='\n')
+
+  def close(self):
+    """Close the underlying file."""
+    self._file.close()
+
+  def __enter__(self):
+    """Context manager entry."""
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    """Close the file on context exit."""
+    self.close()
+
+
+# open_snapshot()
+# -------------------------------------------------------------------------------------------------
+def open_snapshot(path, columns: list = None, progress: bool = False, **kwargs):
+  """ArchiveReader for a .parquet snapshot; otherwise a QueryReader (which reads all columns).
+
+  Other keyword arguments are passed to QueryReader.
+  """
+  if Path(path).suffix == '.parquet':
+    return ArchiveReader(path, columns=columns, progress=progress)
+  return QueryReader(path, progress=progress, **kwargs)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser('Archive snapshots')
+  parser.add_argument('snapshots', nargs='*')
+  args = parser.parse_args()
+
+  if pa is None:
+    sys.exit('pyarrow is needed to archive snapshots')
+  archive_dir.mkdir(exist_ok=True)
+
+  if args.snapshots:
+    snapshots = [Path(snapshot) for snapshot in args.snapshots]
+  else:
+    snapshots = sorted(Path('./downloads').glob('CV*ALL*'), key=lambda path: path.stat().st_mtime)
+
+  manifest = read_manifest()
+  archived_hashes = {entry['content_hash'] for entry in manifest.values()}
+  for snapshot in snapshots:
+    file_hash = content_hash(snapshot)
+    if file_hash in archived_hashes:
+      continue
+    try:
+      entry = archive_snapshot(snapshot, file_hash)
+    except pa.ArrowInvalid as error:
+      print(f'{snapshot.name}: not archived: {error}', file=sys.stderr)
+      continue
+    manifest[f'{snapshot.stem}.parquet'] = entry
+    archived_hashes.add(file_hash)
+    print(f'{snapshot.name:48} {entry["num_rows"]:10,} rows '
+          f'{entry["archive_bytes"] / entry["source_bytes"]:6.1%} of '
+          f'{entry["source_bytes"]:,} bytes')
+
+    # Save the manifest after each snapshot, so an interrupted run loses nothing
+    temp_file = manifest_file.with_suffix('.tmp')
+    temp_file.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    temp_file.replace(manifest_file)
@@ -0,0 +1,86 @@
+#! /usr/local/bin/python3
+"""Row decoders for the transfers query files, compiled once per file from its headers.
+
+The CV_QNS_TRNS_DTL_SRC_CLASS query has changed shape over time: the older files lack the sysdate
+column, and the oldest lack credit_source_type as well. Decoding is driven by column names, not by
+a list of known layouts: every file has base_cols, and optional_cols are the columns that some
+files lack, with the values used for them.
+
+A Schema is built once per file from the file's headers and the fields a loader uses. It compiles
+an itemgetter projection of those fields, plus the converters for any of them that need one, so
+that decoding a row is a single tuple projection. Optional fields that the file lacks get their
+default values instead.
+
+Usage:
+  schema = Schema(reader.headers, ['student_id', 'posted_date', 'credit_source_type'],
+                  converters={'posted_date': query_date})
+  for line in reader:
+    if (row := schema.decode(line)) is None:
+      continue   # wrong number of fields
+    ... row.student_id, row.posted_date, row.credit_source_type ...
+"""
+
+from collections import namedtuple
+from operator import itemgetter
+
+# Columns every file has
+base_cols = ['student_id', 'src_institution', 'enrollment_term', 'enrollment_session',
+             'articulation_term', 'model_status', 'transfer_model_nbr', 'posted_date',
+             'src_subject', 'src_catalog_nbr', 'src_designation', 'src_grade', 'src_gpa',
+             'src_course_id', 'src_offer_nbr', 'src_description', 'academic_program',
+             'units_taken', 'dst_institution', 'dst_designation', 'dst_course_id', 'dst_offer_nbr',
+             'dst_subject', 'dst_catalog_nbr', 'dst_grade', 'dst_gpa']
+
+# Columns that some files lack, with the values used for them
+optional_cols = {'sysdate': None, 'credit_source_type': ''}
+
+
+# class Schema
+# -------------------------------------------------------------------------------------------------
+class Schema:
+  """Decode a file's rows into namedtuples of the fields a loader uses.
+
+  Row:      namedtuple class of the decoded rows; its field names are the fields requested.
+  width:    Number of fields a line of the file must have.
+  """
+
+  def __init__(self, headers: list, fields: list, converters: dict = None):
+    """Compile the projection and converters for a file with these headers.
+
+    Raises ValueError if a field the loader needs is not in the file and is not optional. Headers
+    of archived snapshots are only the columns read, so they need not include every column.
+    """
+    self.width = len(headers)
+    present = [field for field in fields if field in headers]
+    if missing := [field for field in fields
+                   if field not in headers and field not in optional_cols]:
+      raise ValueError(f'no {", ".join(missing)} column{"s" if len(missing) > 1 else ""}')
+    absent = [field for field in fields if field not in headers]
+
+    # The projection yields the present fields in order, followed by the absent ones' defaults
+    self.Row = namedtuple('Row', present + absent)
+    self._defaults = tuple(optional_cols[field] for field in absent)
+    if not present:
+      self._project = lambda line: ()
+    elif len(present) == 1:
+      index = headers.index(present[0])
+      self._project = lambda line: (line[index], )
+    else:
+      self._project = itemgetter(*[headers.index(field) for field in present])
+    self._converters = [(present.index(field), converter)
+                        for field, converter in (converters or dict()).items()
+                        if field in present]
+
+  def decode(self, line):
+    """The requested fields of a line, as a Row; None if the line has the wrong number of fields.
+
+    Converters raise ValueError for values they cannot convert.
+    """
+    if len(line) != self.width:
+      return None
+    values = self._project(line) + self._defaults
+    if self._converters:
+      values = list(values)
+      for index, converter in self._converters:
+        values[index] = converter(values[index])
+    return self.Row._make(values)
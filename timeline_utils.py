@@ -3,3 +3,30 @@
 def min_sec(arg: float) -> str:
   mins, secs = divmod(arg, 60)
   return f'{int(mins)}:{int(secs):02}'
+
+
+def shadow_name(table: str) -> str:
+  """Name of the table a builder loads before swapping it in for table."""
+  return f'{table}_shadow'
+
+
+def swap_in_shadow(cursor, table: str):
+  """Replace table with its fully-built shadow table.
+
+  The old table is dropped, and the shadow table, along with its indexes and partitions (any
+  relation whose name starts with the shadow table's name), is renamed to match. Nothing is
+  committed here: the caller commits, so the swap is a single transaction and readers see either
+  the complete old table or the complete new one.
+  """
+  shadow = shadow_name(table)
+  cursor.execute(f'drop table if exists {table}')
+  cursor.execute("""
+  select c.relname
+    from pg_class c, pg_namespace n
+   where n.oid = c.relnamespace
+     and n.nspname = current_schema()
+     and left(c.relname, %s) = %s
+  """, (len(shadow), shadow))
+  # (ALTER TABLE ... RENAME works for indexes as well as tables.)
+  for (relname, ) in cursor.fetchall():
+    cursor.execute(f'alter table {relname} rename to {table}{relname[len(shadow):]}')
@@ -0,0 +1,573 @@
+#! /usr/local/bin/python3
+"""Parse part of a CV_QNS_TRNS_DTL_SRC_CLASS_FULL query file into the transfers_staging table.
+
+initialize_transfers_applied.py divides the FULL query file at record boundaries and runs
+load_chunk() for each part in a separate process. Each process has its own connection and COPY
+stream into the unlogged transfers_staging table; the caller then merges the staged rows into
+transfers_applied in a single statement.
+
+This is a module rather than part of initialize_transfers_applied.py so that worker processes can
+import it without running that script.
+
+The course attributes that are the same for every student who transfers a course (subject, catalog
+number, designation, description, and flags) are kept in the src_course_dim and dst_course_dim
+tables, keyed by (course_id, offer_nbr), along with the posted_date of the row they came from: a
+course's attributes are those of its latest posting, whatever order snapshots and batches are merged
+in. transfer_facts has just the keys and the per-student facts, and is partitioned by
+articulation_term, one partition (transfer_facts_<term>) per term. transfers_applied is a view that
+joins them, with the columns of the original wide table. Readers that need only fact columns pay
+nothing for the joins: they are outer joins on the dimension tables' primary keys, so the planner
+removes them.
+
+Each fact is identified by its key (student, sending and receiving course and offer numbers,
+articulation term, and posted date), but conflicts are checked on row_key, a 64-bit fingerprint of
+the key that the loaders compute (row_fingerprint(); row_key_sql is the same fingerprint in SQL).
+Its unique index, on (row_key, articulation_term) because a unique index on a partitioned table
+must include the partition key, is much narrower than one on the seven key columns.
+
+Staged rows are merged with merge_staged_rows(), which creates any partitions they need, interns
+their courses, and inserts the facts.
+
+A resumable population (load_chunk() with a batch_size) merges each chunk a batch at a time and
+commits after every batch, recording the chunk's progress in population_progress, so an
+interrupted population can continue from its last checkpoints.
+
+evaluation_events has one row per evaluation: (student, receiving college, articulation term,
+posted date), with the number of courses and units evaluated. evaluation_summary has the first and
+latest evaluation dates, and the number of evaluations, for each (student, college, term).
+"""
+
+import datetime
+import hashlib
+import psycopg
+
+from catalog_flags import REPEATABLE, MESSAGE, BLANKET
+from collections import namedtuple
+from itertools import islice
+from psycopg.rows import namedtuple_row
+from query_reader import QueryReader, query_date
+from skip_accounting import SkipAccount
+from snapshot_schema import Schema, base_cols
+
+cols = ['student_id', 'src_institution', 'enrollment_term', 'enrollment_session',
+        'articulation_term', 'model_status', 'model_nbr', 'posted_date', 'src_subject',
+        'src_catalog_nbr', 'src_designation', 'src_grade', 'src_gpa', 'src_course_id',
+        'src_offer_nbr', 'src_is_repeatable', 'src_description', 'academic_program', 'units_taken',
+        'dst_institution', 'dst_designation', 'dst_course_id', 'dst_offer_nbr', 'dst_subject',
+        'dst_catalog_nbr', 'dst_grade', 'dst_gpa', 'dst_is_message', 'dst_is_blanket', 'row_key']
+
+# transfer_facts columns (other than the generated dst_college), and the dimension tables' columns
+fact_cols = ['student_id', 'src_institution', 'enrollment_term', 'enrollment_session',
+             'articulation_term', 'model_status', 'model_nbr', 'posted_date', 'src_grade',
+             'src_gpa', 'src_course_id', 'src_offer_nbr', 'academic_program', 'units_taken',
+             'dst_institution', 'dst_course_id', 'dst_offer_nbr', 'dst_grade', 'dst_gpa',
+             'credit_source_type', 'row_key']
+src_dim_cols = ['src_course_id', 'src_offer_nbr', 'src_subject', 'src_catalog_nbr',
+                'src_designation', 'src_description', 'src_is_repeatable']
+dst_dim_cols = ['dst_course_id', 'dst_offer_nbr', 'dst_subject', 'dst_catalog_nbr',
+                'dst_designation', 'dst_is_message', 'dst_is_blanket']
+
+transfer_tables_ddl = """
+create table src_course_dim (
+  src_course_id       integer,
+  src_offer_nbr       integer,
+  src_subject         text not NULL,
+  src_catalog_nbr     text not NULL,
+  src_designation     text not NULL,
+  src_description     text not NULL,
+  src_is_repeatable   boolean not NULL,
+  posted_date         date,   -- of the row the attributes came from
+  primary key (src_course_id, src_offer_nbr)
+);
+
+create table dst_course_dim (
+  dst_course_id       integer,
+  dst_offer_nbr       integer,
+  dst_subject         text not NULL,
+  dst_catalog_nbr     text not NULL,
+  dst_designation     text not NULL,
+  dst_is_message      boolean not NULL,
+  dst_is_blanket      boolean not NULL,
+  posted_date         date,   -- of the row the attributes came from
+  primary key (dst_course_id, dst_offer_nbr)
+);
+
+create table transfer_facts (
+  student_id          integer not NULL,
+  src_institution     text not NULL,
+  enrollment_term     integer not NULL,
+  enrollment_session  text not NULL,
+  articulation_term   integer not NULL,
+  model_status        text not NULL,
+  model_nbr           integer not NULL,
+  posted_date         date,
+  src_grade           text not NULL,
+  src_gpa             real not NULL,
+  src_course_id       integer not NULL,
+  src_offer_nbr       integer not NULL,
+  academic_program    text not NULL,
+  units_taken         real not NULL,
+  dst_institution     text not NULL,
+  dst_course_id       integer not NULL,
+  dst_offer_nbr       integer not NULL,
+  dst_grade           text not NULL,
+  dst_gpa             real not NULL,
+  credit_source_type  text,
+
+  -- Fingerprint of (student_id, src_course_id, src_offer_nbr, dst_course_id, dst_offer_nbr,
+  -- articulation_term, posted_date), which identifies the row
+  row_key             bigint not NULL,
+
+  -- Receiving college code (e.g. QNS), for exact-match lookups
+  dst_college         text generated always as (upper(left(dst_institution, 3))) stored
+) partition by list (articulation_term);
+
+-- For conflict checks
+create unique index transfer_facts_row_key on transfer_facts (row_key, articulation_term);
+
+-- Covers evaluation-date lookups by college, term, and student
+create index transfer_facts_evaluations
+    on transfer_facts (dst_college, articulation_term, student_id, posted_date);
+
+-- For loading the keys in the daily update's overlap window
+create index transfer_facts_posted_date on transfer_facts (posted_date);
+
+-- The original wide shape
+create view transfers_applied as
+select f.student_id, f.src_institution, f.enrollment_term, f.enrollment_session,
+       f.articulation_term, f.model_status, f.model_nbr, f.posted_date, s.src_subject,
+       s.src_catalog_nbr, s.src_designation, f.src_grade, f.src_gpa, f.src_course_id,
+       f.src_offer_nbr, s.src_is_repeatable, s.src_description, f.academic_program,
+       f.units_taken, f.dst_institution, d.dst_designation, f.dst_course_id, f.dst_offer_nbr,
+       d.dst_subject, d.dst_catalog_nbr, f.dst_grade, f.dst_gpa, d.dst_is_message,
+       d.dst_is_blanket, f.credit_source_type, f.dst_college
+  from transfer_facts f
+       left join src_course_dim s using (src_course_id, src_offer_nbr)
+       left join dst_course_dim d using (dst_course_id, dst_offer_nbr);
+"""
+
+# Staging table for the loaders' COPY streams
+staging_ddl = """
+create unlogged table if not exists transfers_staging (like transfers_applied including defaults);
+alter table transfers_staging add column if not exists row_key bigint;
+"""
+
+# row_fingerprint() as a SQL expression over transfer_facts columns
+row_key_sql = """
+('x' || left(md5(concat_ws(':', student_id, src_course_id, src_offer_nbr, dst_course_id,
+                           dst_offer_nbr, articulation_term,
+                           to_char(posted_date, 'YYYY-MM-DD'))), 16))::bit(64)::bigint
+"""
+
+# Progress of a resumable population, one row per chunk of the FULL file (see load_batches())
+progress_ddl = """
+create table if not exists population_progress (
+  part_start    bigint primary key,
+  part_end      bigint,
+  content_hash  text,
+  next_offset   bigint,     -- where the next batch starts
+  num_lines     bigint default 0,
+  num_records   bigint default 0,
+  num_staged    bigint default 0,
+  num_added     bigint default 0,
+  last_key      bigint,     -- row_key of the last row staged
+  last_post     date,
+  skip_summary  jsonb,
+  updated_at    timestamp
+);
+"""
+
+# Advisory lock key that serializes resumable chunks' merges
+merge_lock = 0x7472616e
+
+ChunkResult = namedtuple('ChunkResult',
+                         'num_lines num_records num_staged num_added skips last_post')
+
+
+# row_fingerprint()
+# -------------------------------------------------------------------------------------------------
+def row_fingerprint(key: tuple) -> int:
+  """Signed 64-bit fingerprint of a transfer_facts key.
+
+  key is (student_id, src_course_id, src_offer_nbr, dst_course_id, dst_offer_nbr,
+  articulation_term, posted_date), with integers and a date. The fingerprint is the first eight
+  bytes of the MD5 digest of the colon-separated values, so it is the same as row_key_sql.
+  """
+  *numbers, posted_date = key
+  key_text = ':'.join([str(number) for number in numbers] + [posted_date.isoformat()])
+  return int.from_bytes(hashlib.md5(key_text.encode()).digest()[:8], 'big', signed=True)
+
+
+# load_chunk()
+# -------------------------------------------------------------------------------------------------
+def load_chunk(the_file, start: int, end: int, course_flags: dict, cutoff_date: datetime.date,
+               batch_size: int = None) -> ChunkResult:
+  """COPY the posted rows between two record boundaries of the_file into transfers_staging.
+
+  Rows that are not posted, or were posted after cutoff_date, are skipped, as are rows with bad
+  dates or ids; skips counts them by reason. last_post is the latest posted_date seen in the
+  chunk, whether or not its row was skipped.
+
+  If batch_size is given, the chunk is loaded resumably instead: see load_batches().
+  """
+  last_post = None
+  skips = SkipAccount()
+
+  def staged_rows(reader):
+    """Generate the values to stage for each posted row the reader yields."""
+    nonlocal last_post
+    schema = Schema(reader.headers, base_cols, converters={'posted_date': query_date})
+    for line in reader:
+      try:
+        if (row := schema.decode(line)) is None:
+          skips.skip('schema_mismatch', line)
+          continue
+      except ValueError:
+        skips.skip('bad_date', line)
+        continue
+      posted_date = row.posted_date
+      if posted_date is None:
+        # Missing posted_date
+        posted_date = datetime.date(1901, 1, 1)
+      elif last_post is None or last_post < posted_date:
+        last_post = posted_date
+
+      # Skip records that are not posted or which have a posted_date after the cutoff
+      if row.model_status != 'Posted':
+        skips.skip('not_posted', line)
+        continue
+      if posted_date > cutoff_date:
+        skips.skip('after_cutoff', line)
+        continue
+
+      try:
+        src_course_id = int(row.src_course_id)
+        src_offer_nbr = int(row.src_offer_nbr)
+        dst_course_id = int(row.dst_course_id)
+        dst_offer_nbr = int(row.dst_offer_nbr)
+        row_key = row_fingerprint((int(row.student_id), src_course_id, src_offer_nbr,
+                                   dst_course_id, dst_offer_nbr, int(row.articulation_term),
+                                   posted_date))
+      except ValueError:
+        skips.skip('schema_mismatch', line)
+        continue
+      src_catalog_nbr = row.src_catalog_nbr.strip()
+      dst_catalog_nbr = row.dst_catalog_nbr.strip()
+
+      # Is the src course repeatable; is dst course in MESG or BKCR
+      src_flags = course_flags.get((src_course_id, src_offer_nbr), 0)
+      dst_flags = course_flags.get((dst_course_id, dst_offer_nbr), 0)
+      src_is_repeatable = bool(src_flags & REPEATABLE)
+      dst_is_message = bool(dst_flags & MESSAGE)
+      dst_is_blanket = bool(dst_flags & BLANKET)
+
+      yield (row.student_id, row.src_institution, row.enrollment_term,
+             row.enrollment_session, row.articulation_term, row.model_status,
+             row.transfer_model_nbr, posted_date, row.src_subject, src_catalog_nbr,
+             row.src_designation, row.src_grade, row.src_gpa, row.src_course_id,
+             row.src_offer_nbr, src_is_repeatable, row.src_description,
+             row.academic_program, row.units_taken, row.dst_institution,
+             row.dst_designation, row.dst_course_id, row.dst_offer_nbr,
+             row.dst_subject, dst_catalog_nbr, row.dst_grade, row.dst_gpa,
+             dst_is_message, dst_is_blanket, row_key)
+
+  if batch_size:
+    return load_batches(the_file, start, end, staged_rows, skips, lambda: last_post, batch_size)
+
+  num_staged = 0
+  col_list = ','.join(cols)
+  with psycopg.connect('dbname=cuny_transfers') as conn:
+    with conn.cursor() as cursor:
+      with QueryReader(the_file, encoding='utf-8', start=start, end=end) as reader, \
+           cursor.copy(f'copy transfers_staging ({col_list}) from stdin') as copy:
+        for values in staged_rows(reader):
+          copy.write_row(values)
+          num_staged += 1
+
+  # The header line is counted by every chunk's reader; report only the data lines.
+  return ChunkResult(reader.num_lines - 1, reader.num_records, num_staged, 0, skips, last_post)
+
+
+# load_batches()
+# -------------------------------------------------------------------------------------------------
+def load_batches(the_file, start: int, end: int, staged_rows, skips: SkipAccount, get_last_post,
+                 batch_size: int) -> ChunkResult:
+  """Load a chunk resumably, batch_size posted rows at a time, for load_chunk().
+
+  The chunk's row in population_progress records where the next batch starts (a record boundary),
+  the counts so far, the row_key of the last row staged, the latest posted_date, and the skips.
+  Loading starts there, so a chunk whose load was interrupted continues where its last batch
+  ended. Each batch is COPYed into the chunk's own staging table, merged into transfer_facts, and
+  committed along with the chunk's progress row. Merges from different chunks take turns (they
+  share an advisory lock), so they don't contend for the same partitions and dimension rows.
+  """
+  staging = f'transfers_staging_{start}'
+  col_list = ','.join(cols)
+  with psycopg.connect('dbname=cuny_transfers', row_factory=namedtuple_row) as conn:
+    with conn.cursor() as cursor:
+      cursor.execute('select * from population_progress where part_start = %s', (start, ))
+      progress = cursor.fetchone()
+      skips.merge(SkipAccount.from_summary(progress.skip_summary or dict()))
+      last_post = progress.last_post
+      cursor.execute(f"""
+      create unlogged table if not exists {staging} (like transfers_staging including defaults);
+      truncate {staging};
+      """)
+      conn.commit()
+
+      num_lines, num_records = progress.num_lines, progress.num_records
+      num_staged, num_added = progress.num_staged, progress.num_added
+      with QueryReader(the_file, encoding='utf-8', start=progress.next_offset, end=end) as reader:
+        rows = staged_rows(reader)
+        while progress.next_offset < end:
+          batch_staged = 0
+          last_key = progress.last_key
+          with cursor.copy(f'copy {staging} ({col_list}) from stdin') as copy:
+            for values in islice(rows, batch_size):
+              copy.write_row(values)
+              batch_staged += 1
+              last_key = values[-1]
+          next_offset = reader.offset if batch_staged == batch_size else end
+
+          cursor.execute('select pg_advisory_xact_lock(%s)', (merge_lock, ))
+          num_added += merge_staged_rows(cursor, staging).num_added
+          num_staged += batch_staged
+          batch_post = get_last_post()
+          if batch_post is not None and (last_post is None or last_post < batch_post):
+            last_post = batch_post
+          cursor.execute("""
+          update population_progress
+             set next_offset = %s, num_lines = %s, num_records = %s, num_staged = %s,
+                 num_added = %s, last_key = %s, last_post = %s, skip_summary = %s,
+                 updated_at = now()
+           where part_start = %s
+          returning *
+          """, (next_offset, num_lines + reader.num_lines - 1, num_records + reader.num_records,
+                num_staged, num_added, last_key, last_post, skips.to_json(), start))
+          progress = cursor.fetchone()
+          cursor.execute(f'truncate {staging}')
+          conn.commit()
+
+      cursor.execute(f'drop table if exists {staging}')
+
+  return ChunkResult(progress.num_lines, progress.num_records, progress.num_staged,
+                     progress.num_added, skips, progress.last_post)
+
+
+# create_transfer_tables()
+# -------------------------------------------------------------------------------------------------
+def create_transfer_tables(cursor):
+  """Drop transfers_applied (view or table) and the tables behind it; create them empty."""
+  cursor.execute("select relkind from pg_class where oid = to_regclass('transfers_applied')")
+  if (row := cursor.fetchone()) is not None:
+    cursor.execute('drop view transfers_applied' if row[0] == 'v'
+                   else 'drop table transfers_applied cascade')
+  cursor.execute("""
+  drop table if exists transfer_facts cascade;
+  drop table if exists src_course_dim;
+  drop table if exists dst_course_dim;
+  """)
+  cursor.execute(transfer_tables_ddl)
+
+
+# normalize_transfers_applied()
+# -------------------------------------------------------------------------------------------------
+def normalize_transfers_applied(cursor):
+  """Convert a wide transfers_applied table to transfer_facts and the course dimension tables.
+
+  Does nothing if transfers_applied is already a view.
+  """
+  cursor.execute("select relkind from pg_class where oid = to_regclass('transfers_applied')")
+  if (row := cursor.fetchone()) is None or row[0] == 'v':
+    return
+  cursor.execute('alter table transfers_applied rename to transfers_applied_wide')
+  create_transfer_tables(cursor)
+  add_term_partitions(cursor, 'transfers_applied_wide')
+  intern_courses(cursor, 'transfers_applied_wide')
+  fact_list = ', '.join(fact_cols[:-1])
+  cursor.execute(f"""
+  insert into transfer_facts ({fact_list}, row_key)
+  select {fact_list}, {row_key_sql} from transfers_applied_wide
+  on conflict do nothing;
+  drop table transfers_applied_wide cascade;
+  """)
+
+
+# add_row_keys()
+# -------------------------------------------------------------------------------------------------
+def add_row_keys(cursor):
+  """Give a transfer_facts table that has the seven-column primary key a row_key column instead.
+
+  Does nothing if transfer_facts already has row_key.
+  """
+  cursor.execute("""
+  select count(*) from information_schema.columns
+   where table_name = 'transfer_facts' and column_name = 'row_key'
+  """)
+  if cursor.fetchone()[0] > 0:
+    return
+  cursor.execute(f"""
+  alter table transfer_facts add column row_key bigint;
+  update transfer_facts set row_key = {row_key_sql};
+  alter table transfer_facts alter column row_key set not null;
+  create unique index transfer_facts_row_key on transfer_facts (row_key, articulation_term);
+  alter table transfer_facts drop constraint if exists transfer_facts_pkey;
+  """)
+
+
+# add_course_posted_dates()
+# -------------------------------------------------------------------------------------------------
+def add_course_posted_dates(cursor):
+  """Give course dimension tables that lack it the posted_date their attributes came from.
+
+  Existing rows get NULL, so the next posting of each course replaces their attributes.
+  """
+  cursor.execute("""
+  alter table src_course_dim add column if not exists posted_date date;
+  alter table dst_course_dim add column if not exists posted_date date;
+  """)
+
+
+# add_term_partitions()
+# -------------------------------------------------------------------------------------------------
+def add_term_partitions(cursor, source: str = 'transfers_staging'):
+  """Create a transfer_facts partition for each articulation_term in source that doesn't have one
+  yet.
+  """
+  cursor.execute(f'select distinct articulation_term from {source}')
+  for (term, ) in cursor.fetchall():
+    cursor.execute(f"""
+    create table if not exists transfer_facts_{term}
+      partition of transfer_facts for values in ({term})
+    """)
+
+
+# intern_courses()
+# -------------------------------------------------------------------------------------------------
+def intern_courses(cursor, source: str = 'transfers_staging'):
+  """Add the sending and receiving courses in source to the course dimension tables, or update
+  their attributes if source has a later posting of them.
+
+  A course's attributes come from the row with the greatest (posted_date, attributes): the latest
+  posting, with ties broken by the attribute values. The comparison is made against the row
+  already in the table too, so the result does not depend on the order in which sources (e.g. the
+  batches of a resumable population) are merged.
+  """
+  for table, dim_cols in [('src_course_dim', src_dim_cols), ('dst_course_dim', dst_dim_cols)]:
+    col_list = ', '.join(dim_cols + ['posted_date'])
+    key_list = ', '.join(dim_cols[0:2])
+    attributes = dim_cols[2:]
+    rank_list = ', '.join(f'{col} desc' for col in attributes)
+
+    def rank(alias: str) -> str:
+      return ', '.join([f"coalesce({alias}.posted_date, '-infinity')"]
+                       + [f'{alias}.{col}' for col in attributes])
+
+    cursor.execute(f"""
+    insert into {table} as old ({col_list})
+    select distinct on ({key_list}) {col_list} from {source}
+     order by {key_list}, posted_date desc nulls last, {rank_list}
+    on conflict ({key_list})
+    do update set ({', '.join(attributes + ['posted_date'])}) =
+                  ({', '.join(f'excluded.{col}' for col in attributes + ['posted_date'])})
+    where ({rank('excluded')}) > ({rank('old')})
+    """)
+
+
+# merge_staged_rows()
+# -------------------------------------------------------------------------------------------------
+def merge_staged_rows(cursor, source: str = 'transfers_staging'):
+  """Merge a staging table into transfer_facts, the course dimensions, and the evaluation tables.
+
+  Rows whose row_keys are already in transfer_facts, from a previous snapshot or earlier in this
+  one, are skipped by the conflict clause. The facts that are added are also counted in
+  evaluation_events, and the evaluation_summary rows for all the staged students are brought up to
+  date. Returns a row with the number of facts added and their latest posted_date (num_added and
+  max_new_post).
+  """
+  add_term_partitions(cursor, source)
+  intern_courses(cursor, source)
+  fact_list = ', '.join(fact_cols)
+  cursor.execute(f"""
+  with inserted as (
+    insert into transfer_facts ({fact_list})
+    select {fact_list} from {source}
+    on conflict (row_key, articulation_term) do nothing
+    returning student_id, dst_college, articulation_term, posted_date, units_taken
+  ),
+  events as (
+    insert into evaluation_events as old
+    select student_id, dst_college, articulation_term, posted_date, count(*), sum(units_taken)
+      from inserted
+     where posted_date > '1901-01-01'
+     group by 1, 2, 3, 4
+    on conflict (dst_college, articulation_term, student_id, posted_date)
+    do update set num_courses = old.num_courses + excluded.num_courses,
+                  units_taken = old.units_taken + excluded.units_taken
+  )
+  select count(*) as num_added, max(posted_date) as max_new_post from inserted
+  """)
+  merge = cursor.fetchone()
+  summarize_evaluations(cursor, source)
+  return merge
+
+
+# create_evaluation_tables()
+# -------------------------------------------------------------------------------------------------
+def create_evaluation_tables(cursor):
+  """Create and fill evaluation_events and evaluation_summary if they don't exist yet."""
+  cursor.execute("select to_regclass('evaluation_events') is null as is_missing")
+  if not cursor.fetchone()[0]:
+    return
+  cursor.execute("""
+  create table evaluation_events (
+    student_id          integer,
+    dst_college         text,
+    articulation_term   integer,
+    posted_date         date,
+    num_courses         integer,
+    units_taken         real,
+    primary key (dst_college, articulation_term, student_id, posted_date)
+  );
+
+  insert into evaluation_events
+  select student_id, dst_college, articulation_term, posted_date, count(*), sum(units_taken)
+    from transfer_facts
+   where posted_date > '1901-01-01'
+   group by 1, 2, 3, 4;
+
+  drop table if exists evaluation_summary;
+  create table evaluation_summary (
+    student_id          integer,
+    dst_college         text,
+    articulation_term   integer,
+    first_eval          date,
+    latest_eval         date,
+    num_evals           integer,
+    primary key (dst_college, articulation_term, student_id)
+  );
+
+  insert into evaluation_summary
+  select student_id, dst_college, articulation_term, min(posted_date), max(posted_date), count(*)
+    from evaluation_events
+   group by 1, 2, 3;
+  """)
+
+
+# summarize_evaluations()
+# -------------------------------------------------------------------------------------------------
+def summarize_evaluations(cursor, source: str = 'transfers_staging'):
+  """Recompute the evaluation_summary rows for the students in a staging table."""
+  cursor.execute(f"""
+  insert into evaluation_summary
+  select student_id, dst_college, articulation_term, min(posted_date), max(posted_date), count(*)
+    from evaluation_events
+   where (dst_college, articulation_term, student_id) in (
+         select distinct upper(left(dst_institution, 3)), articulation_term, student_id
+           from {source})
+   group by 1, 2, 3
+  on conflict (dst_college, articulation_term, student_id)
+  do update set first_eval = excluded.first_eval,
+                latest_eval = excluded.latest_eval,
+                num_evals = excluded.num_evals
+  """)
@@ -1,31 +1,128 @@
 #! /usr/local/bin/python3
-"""Rebuild all of the timeline tables other than transfers_applied."""
+"""Rebuild all of the timeline tables other than transfers_applied.
 
+The initializer scripts run concurrently, up to --jobs at a time. An initializer starts only after
+all the initializers it depends on have succeeded. Each script's output is printed when it
+finishes, followed by a summary of exit statuses, run times, and table row counts. If any
+initializer fails, exit with an error so the daily update skips generating statistics.
 
+An initializer is not run if its build hash is the same as when it last built its table
+successfully (recorded in the timeline_builds table), and none of the initializers it depends on
+are run. The build hash combines the content hashes of the query file, the initializer script, and
+the shared modules the initializers import, so changing the code rebuilds the table just as a new
+query does. Query hashes come from the query manifest written by check_queries.py; a query file
+with no current manifest entry is hashed here. Use --force to run every initializer.
+"""
+
+import argparse
+import hashlib
+import psycopg
+import sys
+
+from check_queries import current_entry, read_query_manifest
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import date
 from pathlib import Path
+from psycopg.rows import namedtuple_row
+from query_reader import content_hash
 from subprocess import run
 from time import time
 from timeline_utils import min_sec
 
-# Queries and the scripts to rebuild their tables.
+# Initializer scripts, with the query each one uses, the table it builds, and the initializers
+# that must complete before it can start.
+Initializer = namedtuple('Initializer', 'query table depends_on')
 initializers = {
-    'CV_QNS_ADMISSIONS.csv': 'admissions.py',
-    'ADMIT_ACTION_TBL.csv': 'admit_actions.py',
-    'ADMIT_TYPE_TBL.csv': 'admit_types.py',
-    'PROG_REASON_TBL.csv': 'program_reasons.py',
-    'CV_QNS_STUDENT_SUMMARY.csv': 'registrations.py',
-    'QNS_CV_SESSION_TABLE.csv': 'sessions.py'
+    'admissions.py': Initializer('CV_QNS_ADMISSIONS.csv', 'admissions', ()),
+    'admit_actions.py': Initializer('ADMIT_ACTION_TBL.csv', 'admit_actions', ()),
+    'admit_types.py': Initializer('ADMIT_TYPE_TBL.csv', 'admit_types', ()),
+    'program_reasons.py': Initializer('PROG_REASON_TBL.csv', 'program_reasons', ()),
+    'registrations.py': Initializer('CV_QNS_STUDENT_SUMMARY.csv', 'registrations', ()),
+    'sessions.py': Initializer('QNS_CV_SESSION_TABLE.csv', 'sessions', ())
 }
 
+# Modules the initializers share: a change to any of them rebuilds every table
+shared_modules = ['bulk_loader.py', 'query_reader.py', 'timeline_utils.py']
+
+Outcome = namedtuple('Outcome', 'returncode seconds output')
+unchanged_output = 'Not run: query and code unchanged since the last build'
+
+
+# run_initializer()
+# -------------------------------------------------------------------------------------------------
+def run_initializer(initializer: str) -> Outcome:
+  """Run one initializer script, capturing its output so concurrent scripts don't interleave."""
+  start = time()
+  completed = run([f'./{initializer}'], capture_output=True, text=True)
+  return Outcome(completed.returncode, time() - start, completed.stdout + completed.stderr)
+
+
+# run_all()
+# -------------------------------------------------------------------------------------------------
+def run_all(max_workers: int, unchanged: set = frozenset()) -> dict:
+  """Run the initializers in dependency order; return a dict of their Outcomes.
+
+  Initializers whose dependencies failed are not run; their returncode is None. Initializers in
+  unchanged are not run either, unless one of their dependencies ran; their returncode is 0.
+  """
+  outcomes = dict()
+  pending = dict(initializers)
+  running = dict()
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    while pending or running:
+      # Start everything whose dependencies have succeeded; skip anything whose dependencies failed
+      # or that is unchanged. (Repeat until nothing more is skipped, since a skip can resolve
+      # another initializer's dependencies.)
+      resolved = True
+      while resolved:
+        resolved = False
+        for initializer, spec in list(pending.items()):
+          if any(dependency in outcomes and outcomes[dependency].returncode != 0
+                 for dependency in spec.depends_on):
+            outcomes[initializer] = Outcome(None, 0, 'Not run: a dependency failed')
+            del pending[initializer]
+            resolved = True
+          elif (initializer in unchanged
+                and all(dependency in outcomes
+                        and outcomes[dependency].output == unchanged_output
+                        for dependency in spec.depends_on)):
+            print(f'Skip  {initializer:20}  {spec.query} and code unchanged')
+            outcomes[initializer] = Outcome(0, 0, unchanged_output)
+            del pending[initializer]
+            resolved = True
+          elif all(dependency in outcomes for dependency in spec.depends_on):
+            print(f'Start {initializer:20}  {spec.query}')
+            running[executor.submit(run_initializer, initializer)] = initializer
+            del pending[initializer]
+
+      if not running:
+        # Anything still pending is part of a dependency cycle
+        for initializer in pending.keys():
+          outcomes[initializer] = Outcome(None, 0, 'Not run: circular dependency')
+        break
+      done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+      for future in done:
+        initializer = running.pop(future)
+        outcomes[initializer] = future.result()
+        print(f'\n{initializer} finished ({outcomes[initializer].returncode}):\n'
+              f'{outcomes[initializer].output.strip()}')
+  return outcomes
+
+
 if __name__ == '__main__':
   start_time = time()
+  parser = argparse.ArgumentParser('Update timeline tables')
+  parser.add_argument('-j', '--jobs', type=int, default=len(initializers))
+  parser.add_argument('-f', '--force', action='store_true', help='run all initializers')
+  args = parser.parse_args()
+
   """Verify that the queries and their corresponding initializers are available and that the query
      files all have the same date.
   """
   query_date = None
-  for query, initializer in initializers.items():
-    query_file = Path(f'./queries/{query}')
+  for initializer, spec in initializers.items():
+    query_file = Path(f'./queries/{spec.query}')
     assert query_file.is_file(), f'{query_file} not found'
     if query_date is None:
       query_date = date.fromtimestamp(query_file.stat().st_ctime)
@@ -34,10 +131,71 @@ if __name__ == '__main__':
         exit(f'{query_file} has wrong date ({date.fromtimestamp(query_file.stat().st_ctime)})')
     initializer_script = Path(f'./{initializer}')
     assert initializer_script.is_file(), f'{initializer_script} not found'
+    for dependency in spec.depends_on:
+      assert dependency in initializers, f'{initializer} depends on unknown {dependency}'
+
+  # The build hashes, and the ones each initializer last built its table from
+  manifest = read_query_manifest('./queries')
+  module_hashes = [content_hash(module) for module in shared_modules]
+  build_hashes = dict()
+  for initializer, spec in initializers.items():
+    query_file = Path(f'./queries/{spec.query}')
+    if entry := current_entry(query_file, manifest):
+      query_hash = entry['content_hash']
+    else:
+      query_hash = content_hash(query_file)
+    hashes = [query_hash, content_hash(initializer)] + module_hashes
+    build_hashes[initializer] = hashlib.sha256(' '.join(hashes).encode()).hexdigest()
+  with psycopg.connect('dbname=cuny_transfers') as conn:
+    with conn.cursor(row_factory=namedtuple_row) as cursor:
+      cursor.execute("""
+      create table if not exists timeline_builds (
+        initializer   text primary key,
+        query         text,
+        content_hash  text,
+        built_at      timestamp
+      )
+      """)
+      cursor.execute('select initializer, content_hash from timeline_builds')
+      built_hashes = {row.initializer: row.content_hash for row in cursor}
+      unchanged = set()
+      if not args.force:
+        for initializer, spec in initializers.items():
+          cursor.execute('select to_regclass(%s) is not null as has_table', (spec.table, ))
+          if cursor.fetchone().has_table and built_hashes.get(initializer) == \
+             build_hashes[initializer]:
+            unchanged.add(initializer)
+
+  # Run the initializers
+  outcomes = run_all(max(1, args.jobs), unchanged)
+
+  # Record the successful builds, and summarize
+  with psycopg.connect('dbname=cuny_transfers') as conn:
+    with conn.cursor(row_factory=namedtuple_row) as cursor:
+      for initializer, outcome in outcomes.items():
+        if outcome.returncode == 0 and outcome.output != unchanged_output:
+          cursor.execute("""
+          insert into timeline_builds values (%s, %s, %s, now())
+          on conflict (initializer) do update set query = excluded.query,
+                                                  content_hash = excluded.content_hash,
+                                                  built_at = excluded.built_at
+          """, (initializer, initializers[initializer].query, build_hashes[initializer]))
 
-  # Run each initializer
-  for query, initializer in initializers.items():
-    print(f'{initializer:20}  {query}')
-    run(initializer)
+      print(f'\n{"Initializer":20} {"Status":>6} {"Time":>7} {"Rows":>12}')
+      for initializer, spec in initializers.items():
+        outcome = outcomes[initializer]
+        if outcome.returncode == 0:
+          cursor.execute(f'select count(*) as num_rows from {spec.table}')
+          num_rows = f'{cursor.fetchone().num_rows:,}'
+        else:
+          num_rows = ''
+        if outcome.output == unchanged_output:
+          status = 'same'
+        else:
+          status = 'skip' if outcome.returncode is None else outcome.returncode
+        print(f'{initializer:20} {status:>6} {min_sec(outcome.seconds):>7} {num_rows:>12}')
 
   print(f'Total time: {min_sec(time() - start_time)}')
+  failures = [initializer for initializer, outcome in outcomes.items() if outcome.returncode != 0]
+  if failures:
+    sys.exit(f'Failed: {", ".join(failures)}')
@@ -1,176 +1,294 @@
 #! /usr/local/bin/python3
 """Add new rows to transfers_applied.
 
+A snapshot whose contents are identical to one that has already been ingested (same SHA-256 hash
+in update_history, regardless of file name) is skipped without being parsed.
+
+The snapshot may be a CSV query file or an archived (.parquet) one; see snapshot_archive.py. An
+archived snapshot is identified by its source file's name and content hash.
+
 Using query data that covers the past week, so skip rows that already exist.
-  Keep a record of all primary keys to avoid inserts that will fail.
+  The posted rows are streamed into an unlogged staging table with COPY, and then merged into
+  transfers_applied with a single insert ... on conflict do nothing, so rows that already exist
+  cost no database round trips of their own.
+
+With --replay, ingest a series of snapshots, in the order given (default: all of downloads/CV*ALL*
+in the order they were downloaded), in one process. The catalog flags and the row keys already
+in transfers_applied are loaded once; each snapshot then stages only the rows whose keys have not
+been seen before. Each snapshot gets its own update_history row and is committed separately.
+
+A daily snapshot overlaps the previous ones by about a week, so the keys of the rows posted since
+a week before the latest posted_date already ingested (update_history.last_post) are loaded into
+memory first; rows whose keys are among them are discarded without being staged. Keys are compared
+as 64-bit fingerprints (transfer_facts.row_key), so the set of them is small.
+
+Skipped rows are counted by reason, with a few examples of each, in update_history.skip_summary.
 """
 
 import argparse
-import csv
 import datetime
 import psycopg
 import resource
 import sys
 
-from collections import namedtuple
+from catalog_flags import catalog_flags, REPEATABLE, MESSAGE, BLANKET
 from pathlib import Path
 from psycopg.rows import namedtuple_row
+from query_reader import content_hash, query_date
+from skip_accounting import SkipAccount
+from snapshot_archive import manifest_entry, open_snapshot
+from snapshot_schema import Schema
+from transfers_population import (add_course_posted_dates, add_row_keys, create_evaluation_tables,
+                                   merge_staged_rows, normalize_transfers_applied, row_fingerprint,
+                                   staging_ddl)
 
 soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
 resource.setrlimit(resource.RLIMIT_NOFILE, [0x800, hard])
 
-parser = argparse.ArgumentParser('Update Transfers')
-parser.add_argument('-np', '--no_progress', action='store_true')
-parser.add_argument('file', nargs='?')
-args = parser.parse_args()
-progress = not args.no_progress
-
-curric_conn = psycopg.connect('dbname=cuny_curriculum')
-curric_cursor = curric_conn.cursor(row_factory=namedtuple_row)
-trans_conn = psycopg.connect('dbname=cuny_transfers')
-trans_cursor = trans_conn.cursor(row_factory=namedtuple_row)
-
-# If a file was specified on the command line, use that. Otherwise use the latest one found in
-# downloads. The idea is to allow history from previous snapshots to be captured during development,
-# then to use the latest snapshot on a daily basis.
-the_file = args.file
-if the_file is None:
-  # No snapshot specified; use latest available.
-  possibles = Path('./downloads').glob('CV*ALL*')
-  for possible in possibles:
-    if the_file is None or possible.stat().st_mtime > the_file.stat().st_mtime:
-      the_file = possible
-  if the_file is None:
-    sys.exit('No update source found.')
-else:
-  the_file = Path(the_file)
-
-# Using the date the file was transferred to Tumbleweed as a proxy for CF SYSDATE
-file_name = the_file.name
-file_date = datetime.date.fromtimestamp(the_file.stat().st_mtime)
-print('Using:', file_name, file_date.strftime('%B %d, %Y'), file=sys.stderr)
-
-# Caches of all repeatable, message, and blanket credit courses
-curric_cursor.execute("select course_id, offer_nbr from cuny_courses where repeatable = 'Y'")
-repeatables = [(int(row.course_id), int(row.offer_nbr)) for row in curric_cursor.fetchall()]
-curric_cursor.execute("""select course_id, offer_nbr
-                       from cuny_courses
-                       where designation in ('MLA', 'MNL')""")
-messages = [(int(row.course_id), int(row.offer_nbr)) for row in curric_cursor.fetchall()]
-curric_cursor.execute("""select course_id, offer_nbr
-                       from cuny_courses
-                       where attributes ~* 'BKCR'""")
-blankets = [(int(row.course_id), int(row.offer_nbr)) for row in curric_cursor.fetchall()]
-curric_conn.close()
-
-# Latest posted date, and counts for the update_history table
-last_post = None
-num_added = 0
-num_skipped = 0
-max_new_post = None
-
 cols = ['student_id', 'src_institution', 'enrollment_term', 'enrollment_session',
         'articulation_term', 'model_status', 'model_nbr', 'posted_date',
         'src_subject', 'src_catalog_nbr', 'src_designation', 'src_grade', 'src_gpa',
         'src_course_id', 'src_offer_nbr', 'src_is_repeatable', 'src_description',
         'academic_program', 'units_taken', 'dst_institution', 'dst_designation', 'dst_course_id',
         'dst_offer_nbr', 'dst_subject', 'dst_catalog_nbr', 'dst_grade', 'dst_gpa', 'dst_is_message',
-        'dst_is_blanket', 'credit_source_type']
-placeholders = ((len(cols)) * '%s,').strip(', ')
+        'dst_is_blanket', 'credit_source_type', 'row_key']
 cols = ','.join(cols)
 
-# Progress indicators
-num_records = 0
-num_lines = len(open(the_file, newline=None, errors='backslashreplace').readlines()) - 1
-with open(f'./Logs/update_{file_date.isoformat()}.log', 'w') as logfile:
-  with open(the_file, encoding='ascii', errors='backslashreplace') as csv_file:
-    reader = csv.reader(csv_file)
-    for line in reader:
-
-      if reader.line_num == 1:
-        headers = [h.lower().replace(' ', '_') for h in line]
-        Row = namedtuple('Row', headers)
-
-      else:
-        row = Row._make(line)
-        if reader.line_num == 2 and 'sysdate' in headers:
-          mo, da, yr = row.sysdate.split('/')
-          file_date = datetime.date(int(yr), int(mo), int(da))
-
-        num_records += 1
-        if progress:
-          print(f'    {num_records:6,}/{num_lines:6,}\r', end='', file=sys.stderr)
-
-        row = Row._make(line)
-
-        if row.model_status != 'Posted':
-          num_skipped += 1
-          continue
-
-        if '/' in row.posted_date:
-          mo, da, yr = row.posted_date.split('/')
-          posted_date = datetime.date(int(yr), int(mo), int(da))
-        else:
-          posted_date = datetime.date(1901, 1, 1)
-
-        src_course_id = int(row.src_course_id)
-        src_offer_nbr = int(row.src_offer_nbr)
-        src_catalog_nbr = row.src_catalog_nbr.strip()
-        dst_course_id = int(row.dst_course_id)
-        dst_offer_nbr = int(row.dst_offer_nbr)
-        dst_catalog_nbr = row.dst_catalog_nbr.strip()
-        try:
-          credit_source_type = row.credit_source_type
-        except AttributeError:
-          credit_source_type = ''
-
-        # Is the src course is repeatable; is dst course is MESG or BKCR
-        src_is_repeatable = (src_course_id, src_offer_nbr) in repeatables
-        dst_is_message = (dst_course_id, dst_offer_nbr) in messages
-        dst_is_blanket = (dst_course_id, dst_offer_nbr) in blankets
-
-        value_tuple = (row.student_id, row.src_institution, row.enrollment_term,
-                       row.enrollment_session, row.articulation_term, row.model_status,
-                       row.transfer_model_nbr, posted_date, row.src_subject, src_catalog_nbr,
-                       row.src_designation, row.src_grade, row.src_gpa, row.src_course_id,
-                       row.src_offer_nbr, src_is_repeatable, row.src_description,
-                       row.academic_program, row.units_taken, row.dst_institution,
-                       row.dst_designation, row.dst_course_id, row.dst_offer_nbr, row.dst_subject,
-                       dst_catalog_nbr, row.dst_grade, row.dst_gpa, dst_is_message, dst_is_blanket,
-                       credit_source_type)
-        trans_cursor.execute(f'insert into transfers_applied ({cols}) values ({placeholders}) '
-                             f'on conflict do nothing',
-                             value_tuple)
-        if trans_cursor.rowcount == 0:
-          print(f'Skipped {value_tuple}', file=logfile)
-          num_skipped += 1
-        else:
-          assert trans_cursor.rowcount == 1, (f'inserted {trans_cursor.rowcount} rows\n'
-                                              f'{trans_cursor.query}')
-          num_added += trans_cursor.rowcount
-          if (max_new_post is None) or (posted_date > max_new_post):
-            max_new_post = posted_date
-
-  # Report difference between num_lines and num_records.
-  print(f'Lines: {num_lines}\nRecords: {num_records}', file=logfile)
-
-  # Prepare summary info
-  if max_new_post is None:
-    max_new_post = 'NULL'
+# Query columns used (only these are read from an archived snapshot)
+query_cols = ['sysdate', 'student_id', 'src_institution', 'enrollment_term', 'enrollment_session',
+              'articulation_term', 'model_status', 'transfer_model_nbr', 'posted_date',
+              'src_subject', 'src_catalog_nbr', 'src_designation', 'src_grade', 'src_gpa',
+              'src_course_id', 'src_offer_nbr', 'src_description', 'academic_program',
+              'units_taken', 'dst_institution', 'dst_designation', 'dst_course_id',
+              'dst_offer_nbr', 'dst_subject', 'dst_catalog_nbr', 'dst_grade', 'dst_gpa',
+              'credit_source_type']
+
+# How far back from the latest posted_date already ingested a daily snapshot reaches
+overlap_window = datetime.timedelta(days=7)
+
+
+# seen_keys()
+# -------------------------------------------------------------------------------------------------
+def seen_keys(trans_conn, since: datetime.date = None) -> set:
+  """The row_keys of the rows in transfer_facts (only those posted on or after since, if given)."""
+  with trans_conn.cursor() as key_cursor:
+    if since is None:
+      key_cursor.execute('select row_key from transfer_facts')
+    else:
+      key_cursor.execute('select row_key from transfer_facts where posted_date >= %s', (since, ))
+    return {row_key for (row_key, ) in key_cursor}
+
+
+# watermark()
+# -------------------------------------------------------------------------------------------------
+def watermark(trans_conn) -> datetime.date:
+  """The latest posted_date ingested so far, or None if there is no update history."""
+  with trans_conn.cursor() as history_cursor:
+    history_cursor.execute('select max(last_post) from update_history')
+    return history_cursor.fetchone()[0]
+
+
+# ingest_snapshot()
+# -------------------------------------------------------------------------------------------------
+def ingest_snapshot(the_file: Path, trans_conn, course_flags: dict, progress: bool,
+                    known_keys: set = None, backend: str = 'stdlib'):
+  """Add the new rows in one snapshot to transfers_applied, and record it in update_history.
+
+  If known_keys is given, rows whose row_keys are in it are not staged, and the row_keys of the
+  rows that are staged are added to it. backend selects the QueryReader backend for CSV files.
+  Commits when done.
+  """
+  trans_cursor = trans_conn.cursor(row_factory=namedtuple_row)
+
+  # Using the date the file was transferred to Tumbleweed as a proxy for CF SYSDATE
+  file_name = the_file.name
+  file_date = datetime.date.fromtimestamp(the_file.stat().st_mtime)
+  print('Using:', file_name, file_date.strftime('%B %d, %Y'), file=sys.stderr)
+
+  # Skip snapshots whose contents have already been ingested
+  if archived := manifest_entry(the_file):
+    file_name = archived['source']
+    file_date = datetime.date.fromisoformat(archived['snapshot_date'])
+    file_hash = archived['content_hash']
   else:
-    max_new_post = f"'{max_new_post}'"
+    file_hash = content_hash(the_file)
+  trans_cursor.execute('select file_name from update_history where content_hash = %s',
+                       (file_hash, ))
+  if trans_cursor.rowcount > 0:
+    print(f'{file_name} has the same contents as {trans_cursor.fetchone().file_name}: skipped',
+          file=sys.stderr)
+    trans_conn.commit()
+    return
+
+  # Latest posted date, and counts for the update_history table
+  num_added = 0
+  skips = SkipAccount()
+  max_new_post = None
+
+  # Staging table for the posted rows in this snapshot
+  trans_cursor.execute(staging_ddl)
+  trans_cursor.execute('truncate transfers_staging')
+
+  num_posted = 0
+  with open(f'./Logs/update_{file_date.isoformat()}.log', 'w') as logfile:
+    with open_snapshot(the_file, columns=query_cols, progress=progress,
+                       backend=backend) as reader:
+      headers = reader.headers
+      try:
+        schema = Schema(headers, query_cols)
+      except ValueError as error:
+        print(f'{file_name}: {error}', file=logfile)
+        print(f'{file_name}: {error}: skipped', file=sys.stderr)
+        trans_conn.rollback()
+        return
+      with trans_cursor.copy(f'copy transfers_staging ({cols}) from stdin') as copy:
+        for line in reader:
+          if (row := schema.decode(line)) is None:
+            skips.skip('schema_mismatch', line)
+            continue
+          if reader.num_records == 1 and row.sysdate is not None:
+            file_date = query_date(row.sysdate)
 
-  trans_cursor.execute(f"""
-      insert into update_history values(
+          if row.model_status != 'Posted':
+            skips.skip('not_posted', line)
+            continue
+
+          try:
+            posted_date = query_date(row.posted_date) or datetime.date(1901, 1, 1)
+          except ValueError:
+            skips.skip('bad_date', line)
+            continue
+
+          try:
+            src_course_id = int(row.src_course_id)
+            src_offer_nbr = int(row.src_offer_nbr)
+            dst_course_id = int(row.dst_course_id)
+            dst_offer_nbr = int(row.dst_offer_nbr)
+            row_key = row_fingerprint((int(row.student_id), src_course_id, src_offer_nbr,
+                                       dst_course_id, dst_offer_nbr, int(row.articulation_term),
+                                       posted_date))
+          except ValueError:
+            skips.skip('schema_mismatch', line)
+            continue
+          src_catalog_nbr = row.src_catalog_nbr.strip()
+          dst_catalog_nbr = row.dst_catalog_nbr.strip()
+
+          if known_keys is not None:
+            if row_key in known_keys:
+              skips.skip('duplicate_key', line)
+              continue
+            known_keys.add(row_key)
+
+          # Is the src course is repeatable; is dst course is MESG or BKCR
+          src_flags = course_flags.get((src_course_id, src_offer_nbr), 0)
+          dst_flags = course_flags.get((dst_course_id, dst_offer_nbr), 0)
+          src_is_repeatable = bool(src_flags & REPEATABLE)
+          dst_is_message = bool(dst_flags & MESSAGE)
+          dst_is_blanket = bool(dst_flags & BLANKET)
+
+          value_tuple = (row.student_id, row.src_institution, row.enrollment_term,
+                         row.enrollment_session, row.articulation_term, row.model_status,
+                         row.transfer_model_nbr, posted_date, row.src_subject, src_catalog_nbr,
+                         row.src_designation, row.src_grade, row.src_gpa, row.src_course_id,
+                         row.src_offer_nbr, src_is_repeatable, row.src_description,
+                         row.academic_program, row.units_taken, row.dst_institution,
+                         row.dst_designation, row.dst_course_id, row.dst_offer_nbr,
+                         row.dst_subject, dst_catalog_nbr, row.dst_grade, row.dst_gpa,
+                         dst_is_message, dst_is_blanket, row.credit_source_type, row_key)
+          copy.write_row(value_tuple)
+          num_posted += 1
+
+    # Merge the staged rows into transfers_applied. Rows that already exist, either from a
+    # previous snapshot or earlier in this one, are skipped.
+    merge = merge_staged_rows(trans_cursor)
+    num_added = merge.num_added
+    max_new_post = merge.max_new_post
+    skips.add('duplicate_key', num_posted - num_added)
+    num_skipped = skips.total
+    trans_cursor.execute('truncate transfers_staging')
+
+    # Report difference between num_lines and num_records.
+    num_lines = reader.num_lines - 1
+    num_records = reader.num_records
+    print(f'Lines: {num_lines}\nRecords: {num_records}\nPosted: {num_posted}\n'
+          f'Added: {num_added}\nSkipped: {num_skipped}\n{skips}', file=logfile)
+
+    # Prepare summary info
+    if max_new_post is None:
+      max_new_post = 'NULL'
+    else:
+      max_new_post = f"'{max_new_post}'"
+
+    trans_cursor.execute(f"""
+        insert into update_history (file_name, file_date, last_post,
+                                    num_records, num_added, num_skipped, content_hash,
+                                    skip_summary)
+              values('{file_name}', '{file_date}', {max_new_post},
+                     {num_records}, {num_added}, {num_skipped}, '{file_hash}', %s)
+              on conflict do nothing
+      """, (skips.to_json(headers), ))
+    if trans_cursor.rowcount == 0:
+      print(f"""Update History conflict\n new:
             '{file_name}', '{file_date}', {max_new_post},
             {num_records}, {num_added}, {num_skipped})
-            on conflict do nothing
-    """)
-  if trans_cursor.rowcount == 0:
-    print(f"""Update History conflict\n new:
-          '{file_name}', '{file_date}', {max_new_post},
-          {num_records}, {num_added}, {num_skipped})
-          """, file=logfile)
-
-trans_conn.commit()
-trans_conn.close()
+            """, file=logfile)
+
+  trans_conn.commit()
+  print(f'{file_name}: {num_added:,} added; {num_skipped:,} skipped', file=sys.stderr)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser('Update Transfers')
+  parser.add_argument('-np', '--no_progress', action='store_true')
+  parser.add_argument('--replay', action='store_true')
+  parser.add_argument('-a', '--arrow', action='store_true', help='tokenize CSV files with pyarrow')
+  parser.add_argument('files', nargs='*')
+  args = parser.parse_args()
+  progress = not args.no_progress
+
+  # If a file was specified on the command line, use that. Otherwise use the latest one found in
+  # downloads. The idea is to allow history from previous snapshots to be captured during
+  # development, then to use the latest snapshot on a daily basis.
+  possibles = sorted(Path('./downloads').glob('CV*ALL*'), key=lambda path: path.stat().st_mtime)
+  if args.files:
+    the_files = [Path(file) for file in args.files]
+  elif args.replay:
+    the_files = possibles
+  else:
+    the_files = possibles[-1:]
+  if not the_files:
+    sys.exit('No update source found.')
+  if len(the_files) > 1 and not args.replay:
+    sys.exit('Use --replay to ingest more than one snapshot.')
+
+  trans_conn = psycopg.connect('dbname=cuny_transfers')
+  with trans_conn.cursor() as trans_cursor:
+    trans_cursor.execute("""
+        alter table update_history add column if not exists content_hash text;
+        alter table update_history add column if not exists skip_summary jsonb;
+        create index if not exists update_history_content_hash on update_history (content_hash);
+        """)
+    normalize_transfers_applied(trans_cursor)
+    add_row_keys(trans_cursor)
+    add_course_posted_dates(trans_cursor)
+    trans_cursor.execute("""
+        create index if not exists transfer_facts_posted_date on transfer_facts (posted_date)
+        """)
+    create_evaluation_tables(trans_cursor)
+  trans_conn.commit()
+
+  # Repeatable, message, and blanket credit flags for all catalog courses
+  course_flags = catalog_flags()
+
+  # Keys already ingested: all of them for a replay; otherwise those in the overlap window.
+  if args.replay:
+    known_keys = seen_keys(trans_conn)
+  elif (last_post := watermark(trans_conn)) is not None:
+    known_keys = seen_keys(trans_conn, last_post - overlap_window)
+  else:
+    known_keys = None
+  for the_file in the_files:
+    ingest_snapshot(the_file, trans_conn, course_flags, progress, known_keys,
+                    backend='arrow' if args.arrow else 'stdlib')
+
+  trans_conn.close()